@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+__author__ = "ChenyangGao <https://chenyanggao.github.io>"
+__version__ = (0, 0, 1)
+__all__ = ["make_fake_115_application", "FakeP115Client", "run_benchmark"]
+__doc__ = """video-115-302.py 的离线压测工具
+
+会在本地启动一个模拟的 115 服务（实现了 fs_files 和 download_url_app 这 2 个接口，可配置延迟、分页大小和错误率），
+然后用模拟的客户端替换掉 P115Client，启动 video-115-302.py 的 make_application，并依次测量：
+
+1. 冷启动拉取：从空缓存开始，拉取完整个合成的目录树（默认 100 万个视频）所需的时间
+2. 302 跳转：在不同的并发数下，请求直链的吞吐量以及 p50/p99 延迟
+
+注意：压测客户端、模拟的 115 服务和 302 服务运行在同一个进程（同一个事件循环）中，测得的绝对数值偏保守，适合用来对比改动前后的差异。
+"""
+__requirements__ = ["blacksheep", "blacksheep_client_request", "p115client", "uvicorn"]
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, RawTextHelpFormatter
+
+    parser = ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument("-n", "--videos", default=1_000_000, type=int, help="合成的目录树中视频的总数，默认值：1000000")
+    parser.add_argument("-d", "--dirs", default=100, type=int, help="视频被平均分到这么多个目录中，默认值：100")
+    parser.add_argument("-l", "--latency", default=0.05, type=float, help="模拟的 115 接口每次调用的延迟秒数，默认值：0.05")
+    parser.add_argument("-ps", "--page-size", default=1150, type=int, help="模拟的 fs_files 接口单页最多返回的条数（真实接口会截断过大的 limit），默认值：1150")
+    parser.add_argument("-e", "--error-rate", default=0, type=float, help="模拟的 115 接口返回 HTTP 500 的概率，默认值：0")
+    parser.add_argument("-c", "--concurrency", default=[1, 8, 32, 128], type=int, nargs="*", help="302 跳转压测的并发数，可以传多个，默认值：1 8 32 128")
+    parser.add_argument("-r", "--requests", default=2000, type=int, help="每个并发数下发出的请求总数，默认值：2000")
+    parser.add_argument("-k", "--hot", default=200, type=int, help="压测时随机请求的不同文件名的数目（数目越小，直链缓存的命中率越高），默认值：200")
+    parser.add_argument("-w", "--max-workers", default=1, type=int, help="传给 make_application 的 max_workers，默认值：1")
+    parser.add_argument("-cs", "--cache-size", default=1024, type=int, help="传给 make_application 的 cache_size，默认值：1024")
+    parser.add_argument("-ci", "--compact-index", action="store_true", help="传给 make_application 的 compact_index")
+    parser.add_argument("-ct", "--cold-pull-timeout", default=600, type=float, help="冷启动拉取最多等待的秒数，超时则报告已拉取的部分并结束，默认值：600")
+    parser.add_argument("-st", "--stall-timeout", default=30, type=float, help="冷启动拉取时，已拉取的条数在这么多秒内没有增长，则报告已拉取的部分并结束，默认值：30")
+    parser.add_argument("-P", "--port", default=18000, type=int, help="302 服务的端口号，模拟的 115 服务使用下一个端口号，默认值：18000")
+
+    args = parser.parse_args()
+
+try:
+    from blacksheep import json, text, Application, Router
+    from blacksheep.client import ClientSession
+    from blacksheep_client_request import request as blacksheep_request
+    import uvicorn
+except ImportError:
+    from sys import executable
+    from subprocess import run
+    run([executable, "-m", "pip", "install", "-U", *__requirements__], check=True)
+    from blacksheep import json, text, Application, Router
+    from blacksheep.client import ClientSession
+    from blacksheep_client_request import request as blacksheep_request
+    import uvicorn
+
+from asyncio import create_task, gather, run, sleep
+from collections.abc import Callable
+from importlib.util import module_from_spec, spec_from_file_location
+from logging import Handler, LogRecord, ERROR
+from math import inf
+from pathlib import Path
+from random import Random, random
+from time import perf_counter, time
+from types import ModuleType
+
+
+def make_fake_115_application(
+    videos: int = 1_000_000, 
+    dirs: int = 100, 
+    latency: float = 0.05, 
+    page_size: int = 1150, 
+    error_rate: float = 0, 
+    base_url: str = "http://127.0.0.1", 
+) -> Application:
+    """模拟的 115 服务，目录 id 为 1..dirs，每个目录中的视频是按需生成的，不占用内存
+
+    :param videos: 视频的总数
+    :param dirs: 目录数
+    :param latency: 每次调用接口的延迟秒数
+    :param page_size: fs_files 接口单页最多返回的条数
+    :param error_rate: 返回 HTTP 500 的概率
+    :param base_url: 生成直链时所用的 origin
+    """
+    app = Application(router=Router())
+    # 所有视频的更新时间都早于此时间戳，越靠前的视频越新
+    mtime_base = int(time())
+
+    def count_videos(cid: int, /) -> int:
+        if not 1 <= cid <= dirs:
+            return 0
+        return videos // dirs + (cid <= videos % dirs)
+
+    async def simulate():
+        await sleep(latency)
+        if error_rate > 0 and random() < error_rate:
+            return text("simulated error", 500)
+        return None
+
+    @app.router.route("/files", methods=["GET"])
+    async def fs_files(cid: int = 0, offset: int = 0, limit: int = 32):
+        if resp := await simulate():
+            return resp
+        total = count_videos(cid)
+        stop = min(total, offset + min(limit, page_size))
+        return json({
+            "state": True, 
+            "count": total, 
+            "offset": offset, 
+            "path": [{"cid": "0"}, {"cid": str(cid)}], 
+            "data": [
+                {"n": f"{cid}-{i:07d}.mkv", "pc": f"pc{cid}x{i}", "te": str(mtime_base - i)}
+                for i in range(offset, stop)
+            ], 
+        })
+
+    @app.router.route("/downloadurl", methods=["GET"])
+    async def download_url_app(pickcode: str = ""):
+        if resp := await simulate():
+            return resp
+        cid, _, i = pickcode.removeprefix("pc").partition("x")
+        if not (cid.isdecimal() and i.isdecimal() and int(i) < count_videos(int(cid))):
+            return json({"state": False, "message": "file not found"})
+        return json({
+            "state": True, 
+            "data": {i: {
+                "file_name": f"{cid}-{int(i):07d}.mkv", 
+                "pick_code": pickcode, 
+                "url": {"url": f"{base_url}/cdn/{pickcode}?t={int(time()) + 7200}"}, 
+            }}, 
+        })
+
+    return app
+
+
+class FakeP115Client:
+    """模拟的 P115Client，只实现了 video-115-302.py 用到的那部分，请求会发往 base_url 处的模拟的 115 服务
+    """
+    base_url = "http://127.0.0.1"
+
+    def __init__(self, /, cookies="", app: str = "", check_for_relogin: bool = False):
+        self.cookies = cookies
+
+    @property
+    def async_session(self, /) -> ClientSession:
+        return ClientSession()
+
+    def fs_files(
+        self, 
+        payload: dict, 
+        /, 
+        async_: bool = True, 
+        request: Callable = blacksheep_request, 
+        session: None | ClientSession = None, 
+    ):
+        return request(f"{self.base_url}/files", params=payload, parse=True, session=session)
+
+    def download_url_app(
+        self, 
+        pickcode: str, 
+        /, 
+        headers: None | dict = None, 
+        async_: bool = True, 
+        request: Callable = blacksheep_request, 
+        session: None | ClientSession = None, 
+    ):
+        return request(
+            f"{self.base_url}/downloadurl", 
+            params={"pickcode": pickcode}, 
+            headers=headers, 
+            parse=True, 
+            session=session, 
+        )
+
+
+def load_video_115_302() -> ModuleType:
+    "加载同一目录下的 video-115-302.py（文件名中有 -，不能直接导入）"
+    spec = spec_from_file_location("video_115_302", Path(__file__).parent / "video-115-302.py")
+    module = module_from_spec(spec) # type: ignore
+    spec.loader.exec_module(module) # type: ignore
+    return module
+
+
+async def serve(app, port: int, /) -> tuple[uvicorn.Server, object]:
+    "在后台启动一个 uvicorn 服务，等它就绪后返回"
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await sleep(0.01)
+    return server, task
+
+
+async def get_name_cache_size(session: ClientSession, origin: str, /) -> int:
+    resp = await session.get(f"{origin}/metrics")
+    for line in (await resp.text()).splitlines():
+        if line.startswith("video_115_302_name_cache_size "):
+            return int(line.rpartition(" ")[-1])
+    return 0
+
+
+class ErrorCounter(Handler):
+    "统计 ERROR 及以上级别的日志条数（例如拉取目录失败），以便压测及时发现并结束等待"
+
+    def __init__(self, /):
+        super().__init__(ERROR)
+        self.count = 0
+
+    def emit(self, /, record: LogRecord):
+        self.count += 1
+
+
+async def wait_cold_pull(
+    session: ClientSession, 
+    origin: str, 
+    videos: int, 
+    errors: ErrorCounter, 
+    timeout: float = 600, 
+    stall_timeout: float = 30, 
+) -> tuple[int, str]:
+    """等待 302 服务拉取完所有视频，返回 (已拉取的条数, 结束的原因)
+
+    结束的原因为 complete（全部拉取完成）、error（拉取出错，interval 为 inf 时出错的目录不会再被拉取，不可能完成）、
+    stalled（已拉取的条数在 stall_timeout 秒内没有增长）或 timeout（超过 timeout 秒）
+    """
+    start = last_grow = perf_counter()
+    last_size = 0
+    while True:
+        size = await get_name_cache_size(session, origin)
+        now = perf_counter()
+        if size >= videos:
+            return size, "complete"
+        if errors.count:
+            return size, "error"
+        if size > last_size:
+            last_size, last_grow = size, now
+        elif now - last_grow >= stall_timeout:
+            return size, "stalled"
+        if now - start >= timeout:
+            return size, "timeout"
+        await sleep(0.1)
+
+
+def percentile(values: list[float], q: float, /) -> float:
+    "values 需要是升序的"
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_benchmark(
+    videos: int = 1_000_000, 
+    dirs: int = 100, 
+    latency: float = 0.05, 
+    page_size: int = 1150, 
+    error_rate: float = 0, 
+    concurrency: list[int] = [1, 8, 32, 128], 
+    requests: int = 2000, 
+    hot: int = 200, 
+    max_workers: int = 1, 
+    cache_size: int = 1024, 
+    compact_index: bool = False, 
+    port: int = 18000, 
+    cold_pull_timeout: float = 600, 
+    stall_timeout: float = 30, 
+) -> dict:
+    "运行压测，返回测量结果"
+    module = load_video_115_302()
+    fake_origin = f"http://127.0.0.1:{port + 1}"
+    origin = f"http://127.0.0.1:{port}"
+    FakeP115Client.base_url = fake_origin
+    module.P115Client = FakeP115Client # type: ignore
+    fake_app = make_fake_115_application(
+        videos=videos, 
+        dirs=dirs, 
+        latency=latency, 
+        page_size=page_size, 
+        error_rate=error_rate, 
+        base_url=fake_origin, 
+    )
+    # interval 为 inf，只拉取一次，压测期间不会再轮询
+    app = module.make_application(
+        cids=[str(cid) for cid in range(1, dirs + 1)], 
+        interval=inf, 
+        max_workers=max_workers, 
+        cache_size=cache_size, 
+        compact_index=compact_index, 
+    )
+    errors = ErrorCounter()
+    getattr(app, "logger").addHandler(errors)
+    result: dict = {"cold_pull": {}, "redirect": []}
+    fake_server, fake_task = await serve(fake_app, port + 1)
+    start = perf_counter()
+    server, task = await serve(app, port)
+    try:
+        async with ClientSession(follow_redirects=False) as session:
+            # 1. 冷启动拉取
+            size, reason = await wait_cold_pull(session, origin, videos, errors, cold_pull_timeout, stall_timeout)
+            seconds = perf_counter() - start
+            result["cold_pull"] = {
+                "videos": size, 
+                "expected": videos, 
+                "reason": reason, 
+                "seconds": seconds, 
+                "videos_per_second": size / seconds, 
+            }
+            print(f"cold pull ({reason}): {size}/{videos} videos in {seconds:.3f} seconds ({size / seconds:.1f} videos/s)")
+            # 没有拉取完整时，随机选取的文件名可能不存在，302 跳转的压测结果没有意义
+            if reason != "complete":
+                print("cold pull is incomplete, skip the redirect benchmark")
+                return result
+            # 2. 302 跳转
+            rng = Random(0)
+            per_dir = max(videos // dirs, 1)
+            names = [f"{rng.randint(1, dirs)}-{rng.randrange(per_dir):07d}.mkv" for _ in range(hot)]
+            for n in concurrency:
+                latencies: list[float] = []
+                errors = 0
+                async def worker(quota: int, /):
+                    nonlocal errors
+                    for _ in range(quota):
+                        this_start = perf_counter()
+                        resp = await session.get(f"{origin}/{rng.choice(names)}")
+                        await resp.read()
+                        latencies.append(perf_counter() - this_start)
+                        if resp.status != 302:
+                            errors += 1
+                this_start = perf_counter()
+                await gather(*(worker(requests // n + (i < requests % n)) for i in range(n)))
+                seconds = perf_counter() - this_start
+                latencies.sort()
+                stat = {
+                    "concurrency": n, 
+                    "requests": len(latencies), 
+                    "errors": errors, 
+                    "rps": len(latencies) / seconds, 
+                    "p50": percentile(latencies, 0.5), 
+                    "p99": percentile(latencies, 0.99), 
+                }
+                result["redirect"].append(stat)
+                print("concurrency={concurrency:<5} requests={requests:<7} errors={errors:<5} rps={rps:<10.1f} p50={p50:.6f}s p99={p99:.6f}s".format(**stat))
+    finally:
+        server.should_exit = True
+        await task
+        fake_server.should_exit = True
+        await fake_task
+    return result
+
+
+if __name__ == "__main__":
+    run(run_benchmark(
+        videos=args.videos, 
+        dirs=args.dirs, 
+        latency=args.latency, 
+        page_size=args.page_size, 
+        error_rate=args.error_rate, 
+        concurrency=args.concurrency, 
+        requests=args.requests, 
+        hot=args.hot, 
+        max_workers=args.max_workers, 
+        cache_size=args.cache_size, 
+        compact_index=args.compact_index, 
+        port=args.port, 
+        cold_pull_timeout=args.cold_pull_timeout, 
+        stall_timeout=args.stall_timeout, 
+    ))
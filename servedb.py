@@ -68,6 +68,14 @@ if __name__ == "__main__":
         path.suffix.lower() in (".nfo", ".ass", ".ssa", ".srt", ".idx", ".sub", ".txt", ".vtt", ".smi")
     )'
 """)
+    parser.add_argument("-mr", "--max-readers", default=16, type=int, help="只读连接池中最多保留的空闲连接数，默认值：16")
+    parser.add_argument("-cs", "--children-cache-size", default=1024, type=int, help="缓存多少个目录的子项列表（数据库变动后会清空），默认值：1024")
+    parser.add_argument("-pc", "--predicate-cache-size", default=262144, type=int, help="在内存中缓存多少条断言结果，默认值：262144")
+    parser.add_argument("-pp", "--persist-predicate", action="store_true", help="把断言结果保存到 -file 数据库中，重启后不必重新计算（断言改变后会自动清空）")
+    parser.add_argument("-sm", "--stream-propfind-min", default=1024, type=int, help="""PROPFIND（Depth: 1 或 infinity）要罗列的目录中至少有这么多项时，边查询边输出 XML，默认值：1024
+流式响应没有 Content-Length，所以响应结束后会关闭连接（客户端的下一个请求要重新建立连接），
+因此较小的目录仍然先构建完整的 XML 再输出，以保持连接复用
+如果小于 0，则都用 wsgidav 的默认实现（先构建完整的 XML 再输出）""")
     parser.add_argument("-H", "--host", default="0.0.0.0", help="ip 或 hostname，默认值：'0.0.0.0'")
     parser.add_argument("-P", "--port", default=9000, type=int, help="端口号，默认值：9000")
     parser.add_argument("-d", "--debug", action="store_true", help="启用 debug 模式，当文件变动时自动重启 + 输出详细的错误信息")
@@ -86,10 +94,12 @@ try:
     from urllib3.poolmanager import PoolManager
     from urllib3_request import request as urllib3_request
     from werkzeug.middleware.dispatcher import DispatcherMiddleware
+    from wsgidav import util as wsgidav_util
     from wsgidav.wsgidav_app import WsgiDAVApp
     from wsgidav.dav_error import DAVError
     from wsgidav.dav_provider import DAVCollection, DAVNonCollection, DAVProvider
     from wsgidav.server.server_cli import SUPPORTED_SERVERS
+    from wsgidav.xml_tools import make_multistatus_el, xml_to_bytes
     from yaml import load, Loader
 except ImportError:
     from sys import executable
@@ -102,19 +112,23 @@ except ImportError:
     from urllib3.poolmanager import PoolManager
     from urllib3_request import request as urllib3_request
     from werkzeug.middleware.dispatcher import DispatcherMiddleware
+    from wsgidav import util as wsgidav_util # type: ignore
     from wsgidav.wsgidav_app import WsgiDAVApp # type: ignore
     from wsgidav.dav_error import DAVError # type: ignore
     from wsgidav.dav_provider import DAVCollection, DAVNonCollection, DAVProvider # type: ignore
     from wsgidav.server.server_cli import SUPPORTED_SERVERS # type: ignore
+    from wsgidav.xml_tools import make_multistatus_el, xml_to_bytes # type: ignore
     from yaml import load, Loader
 
-from collections.abc import Callable, Mapping, ItemsView
+from collections.abc import Callable, Iterator, Mapping, ItemsView
+from contextlib import closing, contextmanager
 from functools import cached_property, partial
 from io import BytesIO
+from logging import getLogger, Filter, LogRecord, DEBUG, ERROR
 from pathlib import Path
-from posixpath import dirname, splitext
-from sqlite3 import connect, Connection, OperationalError
-from threading import Lock
+from posixpath import splitext
+from sqlite3 import connect, Blob, Connection, OperationalError
+from threading import local, Lock
 from typing import Literal
 
 
@@ -165,12 +179,157 @@ class LRUDict(dict):
         self.clean()
 
 
+class ReadConnectionPool:
+    """只读的 sqlite 连接池，每次使用时取出一个连接，用完后放回，使得多个线程可以并行读取（数据库需要是 WAL 模式）
+
+    :param dbfile: 数据库文件路径
+    :param attach: 需要附加的数据库，别名 -> 文件路径，同样以只读方式打开
+    :param functions: 需要注册的自定义函数，名字 -> 函数（只接受 1 个参数）
+    :param maxsize: 最多保留的空闲连接数，并发更多时会临时创建连接，用完后关闭
+    """
+
+    def __init__(
+        self, 
+        /, 
+        dbfile: str | Path, 
+        attach: Mapping[str, str | Path] = {}, 
+        functions: Mapping[str, Callable] = {}, 
+        maxsize: int = 16, 
+    ):
+        self.dbfile = dbfile
+        self.attach = attach
+        self.functions = functions
+        self.maxsize = maxsize
+        self.idle: list[Connection] = []
+        self.lock = Lock()
+
+    def new_connection(self, /) -> Connection:
+        con = connect(Path(self.dbfile).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+        for name, func in self.functions.items():
+            con.create_function(name, 1, func, deterministic=True)
+        for alias, path in self.attach.items():
+            con.execute(f"ATTACH DATABASE ? AS {alias};", (Path(path).absolute().as_uri() + "?mode=ro",))
+        return con
+
+    def acquire(self, /) -> Connection:
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.new_connection()
+
+    def release(self, con: Connection, /):
+        if con.in_transaction:
+            con.rollback()
+        with self.lock:
+            if len(self.idle) < self.maxsize:
+                self.idle.append(con)
+                return
+        con.close()
+
+    @contextmanager
+    def connect(self, /) -> Iterator[Connection]:
+        "取出一个连接，退出时放回"
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release(con)
+
+    def close(self, /):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for con in idle:
+            con.close()
+
+
+class PooledBlob:
+    """包装 sqlite 的 Blob，关闭时把所用的连接放回连接池
+
+    :param blob: 打开的 Blob
+    :param pool: 连接池
+    :param con: 打开 Blob 所用的连接
+    """
+
+    def __init__(self, /, blob: Blob, pool: ReadConnectionPool, con: Connection):
+        self.blob = blob
+        self.pool = pool
+        self.con: None | Connection = con
+
+    def __getattr__(self, attr, /):
+        return getattr(self.blob, attr)
+
+    def __del__(self, /):
+        self.close()
+
+    def __enter__(self, /):
+        return self
+
+    def __exit__(self, /, *exc_info):
+        self.close()
+
+    def close(self, /):
+        if (con := self.con) is not None:
+            self.con = None
+            try:
+                self.blob.close()
+            finally:
+                self.pool.release(con)
+
+
+class StreamingLogFilter(Filter):
+    """wsgidav 对没有 Content-Length 的响应会记录一条 ERROR 日志（并关闭连接），但流式响应本来就没有 Content-Length，
+    所以在 streaming() 的上下文中（同一线程），把这条日志降为 DEBUG，只有 wsgidav 的日志开启了 DEBUG 时才输出
+
+    wsgidav 的 ErrorPrinter 会把 start_response 推迟到响应体产生第一块数据时才调用，所以响应体要经过 wrap()
+    """
+
+    def __init__(self, /):
+        super().__init__()
+        self.local = local()
+
+    @contextmanager
+    def streaming(self, /):
+        self.local.active = True
+        try:
+            yield
+        finally:
+            self.local.active = False
+
+    def wrap(self, /, it: Iterator[bytes]) -> Iterator[bytes]:
+        "产生第一块数据时也处于 streaming() 的上下文中"
+        try:
+            with self.streaming():
+                for chunk in it:
+                    yield chunk
+                    break
+            yield from it
+        finally:
+            if close := getattr(it, "close", None):
+                close()
+
+    def filter(self, /, record: LogRecord) -> bool:
+        if (
+            getattr(self.local, "active", False) and 
+            record.levelno >= ERROR and 
+            record.getMessage().startswith("Missing required Content-Length header")
+        ):
+            record.levelno, record.levelname = DEBUG, "DEBUG"
+            return getLogger(record.name).isEnabledFor(DEBUG)
+        return True
+
+
 def make_application(
     dbfile: str | Path, 
     config_path: str | Path = "", 
     cookies_path: str | Path = "", 
     predicate: None | Callable = None, 
     strm_predicate: None | Callable = None, 
+    max_readers: int = 16, 
+    children_cache_size: int = 1024, 
+    predicate_cache_size: int = 262144, 
+    persist_predicate: bool = False, 
+    predicate_key: str = "", 
+    stream_propfind_min: int = 1024, 
 ) -> DispatcherMiddleware:
     if config_path:
         config = load(open(config_path, encoding="utf-8"), Loader=Loader)
@@ -183,10 +342,37 @@ def make_application(
     client = P115Client(cookies_path, app="harmony", check_for_relogin=True)
     urlopen = partial(urllib3_request, pool=PoolManager(num_pools=50))
 
-    CON: Connection
+    # 只读连接池，用于所有查询和读取 blob
+    POOL: ReadConnectionPool
+    # 唯一的写连接，用于写入 blob 缓存，需要持有 WRITE_LOCK
+    WRITER: Connection
+    # 专门用来检查 PRAGMA data_version 的连接（data_version 只在同一个连接上前后可比），需要持有 VERSION_LOCK
+    WATCHER: Connection
+    DATA_VERSION = 0
+    VERSION_LOCK = Lock()
+    # data 表是否有 (depth, path) 索引（由 updatedb.py 添加），没有时子树都按路径排序
+    DEPTH_INDEXED = False
+    # 目录 id 到计算好的子项列表的缓存，各个请求间共享，数据库被其它连接（例如 updatedb.py）修改后清空
+    CHILDREN_CACHE: LRUDict = LRUDict(children_cache_size)
+    # (id, mtime, path) 到断言结果的缓存（路径里包含了名字，而且 gitignore 类的断言是对路径做匹配的），结果为 0（不显示）、1（显示）、2（显示为 strm）
+    PREDICATE_CACHE: LRUDict = LRUDict(predicate_cache_size)
+    # 等待保存到 predicate 表的断言结果
+    PREDICATE_PENDING: list[tuple[int, int, str, int]] = []
+    persist_predicate = persist_predicate and bool(predicate or strm_predicate)
+    # 已保存的断言结果只靠 predicate_key 判断是否过期，所以不能为空，否则断言改变后仍会使用旧的结果
+    if persist_predicate and not predicate_key:
+        raise ValueError("predicate_key must be non-empty when persist_predicate is enabled")
+    # 查询时的字段，最后一列是已保存的断言结果（没有则为 NULL）
+    SELECT = "SELECT id, name, path, ctime, mtime, size, pickcode, is_dir, %s FROM data" % (
+        "(SELECT result FROM file.predicate AS p WHERE p.id = data.id AND p.mtime = data.mtime AND p.path = data.path)"
+        if persist_predicate else "NULL"
+    )
     FIELDS = ("id", "name", "path", "ctime", "mtime", "size", "pickcode", "is_dir")
     ROOT = {"id": 0, "name": "", "path": "/", "ctime": 0, "mtime": 0, "size": 0, "pickcode": "", "is_dir": 1}
     STRM_CACHE: LRUDict = LRUDict(65536)
+    # 流式响应时，wsgidav 关于缺少 Content-Length 的 ERROR 日志是预期之内的，降为 DEBUG
+    STREAMING_LOG_FILTER = StreamingLogFilter()
+    getLogger("wsgidav.wsgidav_app").addFilter(STREAMING_LOG_FILTER)
     WRITE_LOCK = Lock()
 
     class DavPathBase:
@@ -280,26 +466,18 @@ def make_application(
             if self.is_strm:
                 return BytesIO(self.strm_data)
             fid = self.attr["id"]
-            try:
-                return CON.blobopen("data", "data", fid, readonly=True, name="file")
-            except (OperationalError, SystemError):
-                pass
+            if content := open_blob(fid):
+                return content
             if self.attr["size"] >= 1024 * 64:
                 raise DAVError(302, add_headers=[("Location", self.url)])
-            CON.execute("""\
-INSERT INTO file.data(id, data) VALUES(?, zeroblob(?)) 
-ON CONFLICT(id) DO UPDATE SET data=excluded.data;""", (fid, self.attr["size"]))
-            CON.commit()
-            try:
-                data = urlopen(self.url).read()
-                with WRITE_LOCK:
-                    with CON.blobopen("data", "data", fid, name="file") as fdst:
-                        fdst.write(data)
-                return CON.blobopen("data", "data", fid, readonly=True, name="file")
-            except:
-                CON.execute("DELETE FROM file WHERE id=?", (fid,))
-                CON.commit()
-                raise
+            # 先下载完整，再一次性写入，所以读者不会读到写了一半的数据
+            data = urlopen(self.url).read()
+            with WRITE_LOCK:
+                WRITER.execute("""\
+INSERT INTO file.data(id, data) VALUES(?, ?) 
+ON CONFLICT(id) DO UPDATE SET data=excluded.data;""", (fid, data))
+                WRITER.commit()
+            return open_blob(fid) or BytesIO(data)
 
         def get_content_length(self, /) -> int:
             return self.size
@@ -326,24 +504,9 @@ ON CONFLICT(id) DO UPDATE SET data=excluded.data;""", (fid, self.attr["size"]))
 
         @cached_property
         def children(self, /) -> dict[str, FileResource | FolderResource]:
-            sql = """\
-SELECT id, name, path, ctime, mtime, size, pickcode, is_dir
-FROM data
-WHERE parent_id = :id AND name NOT IN ('', '.', '..') AND name NOT LIKE '%/%';
-"""
             children: dict[str, FileResource | FolderResource] = {}
             environ = self.environ
-            for r in CON.execute(sql, self.attr):
-                attr = dict(zip(FIELDS, r))
-                is_strm = False
-                name = attr["name"]
-                path = attr["path"]
-                if not attr["is_dir"] and strm_predicate and strm_predicate(MappingPath(attr)):
-                    name = splitext(name)[0] + ".strm"
-                    path = splitext(path)[0] + ".strm"
-                    is_strm = True
-                elif predicate and not predicate(MappingPath(attr)):
-                    continue
+            for name, path, attr, is_strm in list_children(self.attr["id"]):
                 if attr["is_dir"]:
                     children[name] = FolderResource(path, environ, attr)
                 else:
@@ -359,51 +522,89 @@ WHERE parent_id = :id AND name NOT IN ('', '.', '..') AND name NOT LIKE '%/%';
             depth: Literal["0", "1", "infinity"] = "infinity", 
             add_self: bool = False, 
         ) -> list[FileResource | FolderResource]:
-            descendants: list[FileResource | FolderResource] = []
-            push = descendants.append
+            return list(self.iter_descendants(
+                collections=collections, 
+                resources=resources, 
+                depth_first=depth_first, 
+                depth=depth, 
+                add_self=add_self, 
+            ))
+
+        def iter_descendants(
+            self, 
+            /, 
+            collections: bool = True, 
+            resources: bool = True, 
+            depth_first: bool = False, 
+            depth: Literal["0", "1", "infinity"] = "infinity", 
+            add_self: bool = False, 
+        ) -> Iterator[FileResource | FolderResource]:
+            "和 get_descendants 一样，但是边查询边产生，不会把所有结果都放在内存中"
             if collections and add_self:
-                push(self)
+                yield self
             if depth == "0":
-                return descendants
-            elif depth == "1":
-                for item in self.children.values():
-                    if item.attr["is_dir"]:
+                return
+            environ = self.environ
+            if depth == "1":
+                for name, path, attr, is_strm in list_children(self.attr["id"]):
+                    if attr["is_dir"]:
                         if collections:
-                            push(item)
+                            yield FolderResource(path, environ, attr)
                     elif resources:
-                        push(item)
-                return descendants
-            sql = """\
-SELECT id, name, path, ctime, mtime, size, pickcode, is_dir
-FROM data
-WHERE path LIKE ? || '%' AND name NOT IN ('', '.', '..') AND name NOT LIKE '%/%'"""
-            if collections and resources:
-                pass
-            elif collections:
-                sql += " AND is_dir"
-            elif resources:
-                sql += " AND NOT is_dir"
-            else:
-                return descendants
-            if depth_first:
-                sql += "\nORDER BY path"
-            else:
-                sql += "\nORDER BY dirname(path)"
-            environ = self.environ
-            for r in CON.execute(sql, (self.path,)):
-                attr = dict(zip(FIELDS, r))
-                is_strm = False
-                path = attr["path"]
-                if not attr["is_dir"] and strm_predicate and strm_predicate(MappingPath(attr)):
-                    path = splitext(path)[0] + ".strm"
-                    is_strm = True
-                elif predicate and not predicate(MappingPath(attr)):
-                    continue
-                if attr["is_dir"]:
-                    push(FolderResource(path, environ, attr))
-                else:
-                    push(FileResource(path, environ, attr, is_strm=is_strm))
-            return descendants
+                        yield FileResource(path, environ, attr, is_strm=is_strm)
+                return
+            if not (collections or resources):
+                return
+            start, stop = self.path, self.path[:-1] + "0"
+            def fetch(con: Connection, sql: str, params: tuple, /) -> Iterator[list[tuple]]:
+                cur = con.execute(sql, params)
+                try:
+                    while rows := cur.fetchmany(1024):
+                        yield rows
+                finally:
+                    cur.close()
+            def batches(con: Connection, /) -> Iterator[list[tuple]]:
+                "按顺序分批产生子树中（还没有筛选的）所有行"
+                if depth_first or not DEPTH_INDEXED:
+                    # self.path 以 / 结尾，而 '0' 是 '/' 的下一个字符，所以这个范围正好是所有后代，可以走 idx_data_path 索引
+                    yield from fetch(con, SELECT + " WHERE path >= ? AND path < ? ORDER BY path", (start, stop))
+                    return
+                # 逐层查询，每一层在 idx_data_depth_path 索引中都是连续的一段，已经按路径排好序（所以同一个目录下的项目排在一起），不需要再排序
+                row = con.execute("SELECT depth FROM data WHERE parent_id = ? LIMIT 1", (self.attr["id"],)).fetchone()
+                if row is None:
+                    return
+                level = row[0]
+                sql = SELECT + " WHERE depth = ? AND path >= ? AND path < ? ORDER BY path"
+                while True:
+                    found = False
+                    for rows in fetch(con, sql, (level, start, stop)):
+                        found = True
+                        yield rows
+                    # 某一层没有项目时，更深的层也不会有
+                    if not found:
+                        return
+                    level += 1
+            with POOL.connect() as con, closing(batches(con)) as it:
+                for rows in it:
+                    for r in rows:
+                        attr = dict(zip(FIELDS, r))
+                        name = attr["name"]
+                        if name in ("", ".", "..") or "/" in name:
+                            continue
+                        if not (collections if attr["is_dir"] else resources):
+                            continue
+                        result = check_predicate(attr, r[-1])
+                        if not result:
+                            continue
+                        is_strm = result == 2
+                        path = attr["path"]
+                        if is_strm:
+                            path = splitext(path)[0] + ".strm"
+                        if attr["is_dir"]:
+                            yield FolderResource(path, environ, attr)
+                        else:
+                            yield FileResource(path, environ, attr, is_strm=is_strm)
+                    save_predicate_results()
 
         def get_member(self, /, name: str) -> FileResource | FolderResource:
             if res := self.children.get(name):
@@ -423,26 +624,134 @@ WHERE path LIKE ? || '%' AND name NOT IN ('', '.', '..') AND name NOT LIKE '%/%'
                 return True
             return super().get_property_value(name)
 
+    def check_predicate(attr: dict, saved: None | int = None, /) -> int:
+        "执行断言，返回 0（不显示）、1（显示）、2（显示为 strm），对于 (id, mtime, path) 相同的行，结果会被复用"
+        if not (predicate or strm_predicate):
+            return 1
+        if saved is not None:
+            return saved
+        key = (attr["id"], attr["mtime"], attr["path"])
+        if (result := PREDICATE_CACHE.get(key)) is not None:
+            return result
+        if not attr["is_dir"] and strm_predicate and strm_predicate(MappingPath(attr)):
+            result = 2
+        elif predicate and not predicate(MappingPath(attr)):
+            result = 0
+        else:
+            result = 1
+        PREDICATE_CACHE[key] = result
+        if persist_predicate:
+            PREDICATE_PENDING.append((*key, result))
+        return result
+
+    def save_predicate_results():
+        "把新得到的断言结果保存到 predicate 表"
+        if not PREDICATE_PENDING:
+            return
+        with WRITE_LOCK:
+            rows = PREDICATE_PENDING[:]
+            del PREDICATE_PENDING[:len(rows)]
+            WRITER.executemany("""\
+INSERT INTO file.predicate(id, mtime, path, result) VALUES(?, ?, ?, ?) 
+ON CONFLICT(id) DO UPDATE SET mtime=excluded.mtime, path=excluded.path, result=excluded.result;""", rows)
+            WRITER.commit()
+
+    def check_data_version() -> int:
+        "检查数据库是否被修改过，如果是，则清空缓存，返回当前的 data_version"
+        nonlocal DATA_VERSION
+        with VERSION_LOCK:
+            version = WATCHER.execute("PRAGMA data_version;").fetchone()[0]
+            if version != DATA_VERSION:
+                DATA_VERSION = version
+                CHILDREN_CACHE.clear()
+                STRM_CACHE.clear()
+        return version
+
+    def list_children(id: int, /) -> list[tuple[str, str, dict, bool]]:
+        "罗列目录中（经过断言筛选后）的子项，返回 (名字, 路径, 属性, 是否 strm) 的列表"
+        version = check_data_version()
+        if (children := CHILDREN_CACHE.get(id)) is not None:
+            return children
+        sql = SELECT + """
+WHERE parent_id = ? AND name NOT IN ('', '.', '..') AND name NOT LIKE '%/%';
+"""
+        with POOL.connect() as con:
+            rows = con.execute(sql, (id,)).fetchall()
+        entries: dict[str, tuple[str, str, dict, bool]] = {}
+        for r in rows:
+            attr = dict(zip(FIELDS, r))
+            result = check_predicate(attr, r[-1])
+            if not result:
+                continue
+            is_strm = result == 2
+            name = attr["name"]
+            path = attr["path"]
+            if is_strm:
+                name = splitext(name)[0] + ".strm"
+                path = splitext(path)[0] + ".strm"
+            entries[name] = (name, path, attr, is_strm)
+        save_predicate_results()
+        children = list(entries.values())
+        # 查询期间如果数据库被修改过，则结果可能已经过时，不放入缓存
+        if version == DATA_VERSION:
+            CHILDREN_CACHE[id] = children
+        return children
+
+    def open_blob(fid: int, /) -> None | PooledBlob:
+        "打开缓存的文件数据，如果没有则返回 None"
+        con = POOL.acquire()
+        try:
+            return PooledBlob(con.blobopen("data", "data", fid, readonly=True, name="file"), POOL, con)
+        except (OperationalError, SystemError):
+            POOL.release(con)
+            return None
+
     class ServeDBProvider(DAVProvider):
 
         def __init__(self, /, dbfile: str | Path):
-            nonlocal CON
-            CON = connect(dbfile, check_same_thread=False)
-            CON.create_function("dirname", 1, dirname)
-            dbfile = CON.execute("SELECT file FROM pragma_database_list() WHERE name='main';").fetchone()[0]
+            nonlocal POOL, WRITER, WATCHER, DEPTH_INDEXED
+            WRITER = connect(dbfile, check_same_thread=False)
+            DEPTH_INDEXED = bool(WRITER.execute("SELECT 1 FROM pragma_index_list('data') WHERE name = 'idx_data_depth_path'").fetchone())
+            dbfile = WRITER.execute("SELECT file FROM pragma_database_list() WHERE name='main';").fetchone()[0]
             head, suffix = splitext(dbfile)
-            CON.execute("ATTACH DATABASE ? AS file;", (f"{head}-file{suffix}",))
-            CON.execute("""\
+            file_dbfile = f"{head}-file{suffix}"
+            WRITER.execute("ATTACH DATABASE ? AS file;", (file_dbfile,))
+            WRITER.execute("PRAGMA file.journal_mode = WAL;")
+            WRITER.execute("""\
 CREATE TABLE IF NOT EXISTS file.data (
     id INTEGER NOT NULL PRIMARY KEY,
     data BLOB,
     temp_path TEXT
 );""")
+            if persist_predicate:
+                WRITER.executescript("""\
+CREATE TABLE IF NOT EXISTS file.predicate (
+    id INTEGER NOT NULL PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    result INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file.predicate_key (
+    key TEXT NOT NULL
+);""")
+                if WRITER.execute("SELECT key FROM file.predicate_key").fetchall() != [(predicate_key,)]:
+                    WRITER.execute("DELETE FROM file.predicate;")
+                    WRITER.execute("DELETE FROM file.predicate_key;")
+                    WRITER.execute("INSERT INTO file.predicate_key(key) VALUES (?);", (predicate_key,))
+            WRITER.commit()
+            POOL = ReadConnectionPool(
+                dbfile, 
+                attach={"file": file_dbfile}, 
+                maxsize=max_readers, 
+            )
+            WATCHER = POOL.new_connection()
 
         def __del__(self, /):
             try:
-                CON.close()
-            except AttributeError:
+                POOL.close()
+                WATCHER.close()
+                WRITER.close()
+            except NameError:
                 pass
 
         def get_resource_inst(
@@ -451,23 +760,26 @@ CREATE TABLE IF NOT EXISTS file.data (
             path: str, 
             environ: dict, 
         ) -> FolderResource | FileResource:
+            # 先检查数据库是否被修改过，以免从缓存中取到过期的 strm
+            check_data_version()
             if strm := STRM_CACHE.get(path):
                 return strm
             if path in ("/", ""):
                 return FolderResource("/", environ, ROOT)
             path = path.removesuffix("/")
-            sql = "SELECT id, name, path, ctime, mtime, size, pickcode, is_dir FROM data WHERE path = ? LIMIT 1"
-            cur = CON.execute(sql, (path,))
-            record = cur.fetchone()
+            sql = SELECT + " WHERE path = ? LIMIT 1"
+            with POOL.connect() as con:
+                record = con.execute(sql, (path,)).fetchone()
             if not record:
                 raise DAVError(404, path)
             attr = dict(zip(FIELDS, record))
-            is_strm = False
-            if not attr["is_dir"] and strm_predicate and strm_predicate(MappingPath(attr)):
-                is_strm = True
-                path = splitext(path)[0] + ".strm"
-            elif predicate and not predicate(MappingPath(attr)):
+            result = check_predicate(attr, record[-1])
+            save_predicate_results()
+            if not result:
                 raise DAVError(404, path)
+            is_strm = result == 2
+            if is_strm:
+                path = splitext(path)[0] + ".strm"
             if attr["is_dir"]:
                 return FolderResource(path, environ, attr)
             else:
@@ -476,6 +788,95 @@ CREATE TABLE IF NOT EXISTS file.data (
         def is_readonly(self, /) -> bool:
             return True
 
+        def custom_request_handler(self, /, environ: dict, start_response, default_handler):
+            # 只对 Depth 为 1 或 infinity 的目录做流式响应，带有条件请求头时交给 wsgidav 的默认实现去检查
+            if (
+                stream_propfind_min < 0 or 
+                environ["REQUEST_METHOD"] != "PROPFIND" or 
+                environ.setdefault("HTTP_DEPTH", "infinity") not in ("1", "infinity") or 
+                any(key in environ for key in (
+                    "HTTP_IF", "HTTP_IF_MATCH", "HTTP_IF_NONE_MATCH", 
+                    "HTTP_IF_MODIFIED_SINCE", "HTTP_IF_UNMODIFIED_SINCE", 
+                ))
+            ):
+                return default_handler(environ, start_response)
+            res = self.get_resource_inst(environ["PATH_INFO"], environ)
+            if not isinstance(res, FolderResource):
+                return default_handler(environ, start_response)
+            # 流式响应没有 Content-Length，wsgidav 会因此关闭连接，所以小目录还是用默认实现，以保持连接复用
+            if environ["HTTP_DEPTH"] == "1":
+                count = len(list_children(res.attr["id"]))
+            else:
+                # 子树只数到 stream_propfind_min 为止（走 idx_data_path 索引），不必数完整个子树
+                with POOL.connect() as con:
+                    count = con.execute(
+                        "SELECT COUNT(*) FROM (SELECT 1 FROM data WHERE path >= ? AND path < ? LIMIT ?)", 
+                        (res.path, res.path[:-1] + "0", stream_propfind_min), 
+                    ).fetchone()[0]
+            if count < stream_propfind_min:
+                return default_handler(environ, start_response)
+            return self.stream_propfind(res, environ, start_response)
+
+        def stream_propfind(self, /, res: FolderResource, environ: dict, start_response) -> Iterator[bytes]:
+            "流式地响应 PROPFIND：边查询边输出 multistatus XML，内存占用不随目录的大小增长"
+            request_el = wsgidav_util.parse_xml_body(environ, allow_empty=True)
+            mode: None | str = "allprop"
+            name_list: list[str] = []
+            if request_el is not None:
+                if request_el.tag != "{DAV:}propfind":
+                    raise DAVError(400)
+                mode = None
+                for node in request_el:
+                    if node.tag in ("{DAV:}allprop", "{DAV:}name"):
+                        # allprop 和 name 互斥
+                        if mode:
+                            raise DAVError(400)
+                        mode = node.tag[6:]
+                    elif node.tag == "{DAV:}prop":
+                        if mode not in (None, "named"):
+                            raise DAVError(400)
+                        mode = "named"
+                        name_list.extend(n.tag for n in node)
+            mode = mode or "named"
+            # 按路径的顺序（即深度优先）可以直接沿着 idx_data_path 索引读取，不需要先排序，能尽快输出第一批数据
+            it = res.iter_descendants(depth_first=True, depth=environ["HTTP_DEPTH"], add_self=True)
+            # 没有 Content-Length，所以响应结束后必须关闭连接（wsgidav 也会强制这样做），这里直接声明，以免它再告警
+            with STREAMING_LOG_FILTER.streaming():
+                start_response("207 Multi-Status", [
+                    ("Content-Type", "application/xml; charset=utf-8"), 
+                    ("Date", wsgidav_util.get_rfc1123_time()), 
+                    ("Connection", "close"), 
+                ])
+            def gen():
+                # 每 256 个 <response> 放在一个 <multistatus> 中，和 wsgidav 的默认实现一样用 xml_to_bytes 序列化，
+                # 第一批输出到结束标签之前（包括 XML 声明和开始标签），之后的每批只输出其中的 <response>，
+                # 这样 XML 声明和命名空间前缀都和默认实现（无论是否使用 lxml）保持一致
+                end_tag = b""
+                def dump(multistatus_el) -> bytes:
+                    nonlocal end_tag
+                    xml = xml_to_bytes(multistatus_el)
+                    stop = xml.rindex(b"<")
+                    if end_tag:
+                        # XML 声明之后的第一个标签是开始标签
+                        start = xml.index(b">", xml.index(b"<", xml.index(b"?>") + 2)) + 1
+                        return xml[start:stop]
+                    end_tag = xml[stop:]
+                    return xml[:stop]
+                multistatus_el = make_multistatus_el()
+                for child in it:
+                    if mode == "named":
+                        props = child.get_properties("named", name_list=name_list)
+                    else:
+                        props = child.get_properties(mode)
+                    wsgidav_util.add_property_response(multistatus_el, child.get_href(), props)
+                    if len(multistatus_el) >= 256:
+                        yield dump(multistatus_el)
+                        multistatus_el = make_multistatus_el()
+                if len(multistatus_el):
+                    yield dump(multistatus_el)
+                yield end_tag
+            return STREAMING_LOG_FILTER.wrap(gen())
+
     flask_app = Flask(__name__)
     Compress(flask_app)
 
@@ -526,6 +927,7 @@ CREATE TABLE IF NOT EXISTS file.data (
 
 if __name__ == "__main__":
     import re
+    from hashlib import sha1
     from werkzeug.serving import run_simple
 
     if args.fast_strm:
@@ -544,12 +946,27 @@ if __name__ == "__main__":
     elif strm_predicate := args.strm_predicate or None:
         strm_predicate = make_predicate(strm_predicate, {"re": re}, type=args.strm_predicate_type)
 
+    # 断言的标识，如果断言来自文件，则还包括文件的内容
+    predicate_hash = sha1()
+    for value, kind in (
+        (args.predicate, args.predicate_type), 
+        (args.strm_predicate, args.strm_predicate_type), 
+    ):
+        predicate_hash.update(bytes(repr((args.fast_strm, value, kind)), "utf-8"))
+        if value and kind in ("ignore-file", "filter-file", "file"):
+            predicate_hash.update(open(value, "rb").read())
     app = make_application(
         args.dbfile, 
         config_path=args.config_path, 
         cookies_path=args.cookies_path, 
         predicate=predicate, 
         strm_predicate=strm_predicate, 
+        max_readers=args.max_readers, 
+        children_cache_size=args.children_cache_size, 
+        predicate_cache_size=args.predicate_cache_size, 
+        persist_predicate=args.persist_predicate, 
+        predicate_key=predicate_hash.hexdigest(), 
+        stream_propfind_min=args.stream_propfind_min, 
     )
     run_simple(
         hostname=args.host, 
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""video-115-302.py 的测试
+
+其中的端到端测试用 bench-115-302.py 中模拟的 115 服务和 P115Client（所以不需要 p115client），其它的是纯单元测试
+"""
+
+import pytest
+
+pytest.importorskip("blacksheep")
+pytest.importorskip("blacksheep_client_request")
+pytest.importorskip("openapidocs")
+
+from asyncio import run, sleep
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from importlib.util import module_from_spec, spec_from_file_location
+from json import dumps, loads, JSONDecodeError
+from math import inf
+from pathlib import Path
+from random import Random
+from socket import socket
+from types import ModuleType
+
+from blacksheep.client import ClientSession
+from blacksheep.contents import JSONContent
+
+
+def load_module(name: str, filename: str, /) -> ModuleType:
+    "加载仓库根目录下的脚本（文件名中有 -，不能直接导入）"
+    spec = spec_from_file_location(name, Path(__file__).parent.parent / filename)
+    module = module_from_spec(spec) # type: ignore
+    spec.loader.exec_module(module) # type: ignore
+    return module
+
+
+video = load_module("video_115_302", "video-115-302.py")
+
+
+@pytest.fixture(scope="module")
+def bench() -> ModuleType:
+    "压测工具中模拟的 115 服务（需要 uvicorn），只有端到端测试需要"
+    pytest.importorskip("uvicorn")
+    return load_module("bench_115_302", "bench-115-302.py")
+
+
+def free_port() -> int:
+    with socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_fs_files_payload(rng: Random, /) -> dict:
+    "构造一个类似 fs_files 接口响应的对象，包含各种类型的值、转义字符和非 ascii 字符"
+    return {
+        "state": True, 
+        "count": rng.randint(0, 10**9), 
+        "cur": 0, 
+        "offset": -1.5e-3, 
+        "path": [{"cid": "0", "name": "根目录"}, {"cid": "1", "name": 'a "b" \\ c'}], 
+        "data": [
+            {
+                "n": rng.choice(["电影", "film", "été \U0001f3ac", 'x"y\\z\n']) + f"-{i}.mkv", 
+                "pc": f"pc{i}", 
+                "te": str(1700000000 + i), 
+                "s": rng.randint(0, 2**40), 
+                "fid": str(i), 
+                "fl": [{"id": i, "name": "标签"}] if i % 3 else [], 
+                "m": i % 2 == 0, 
+                "e": None, 
+            }
+            for i in range(rng.randint(0, 200))
+        ], 
+        "errNo": 0, 
+        "is_asc": 1, 
+    }
+
+
+def test_json_array_stream_parser_chunked():
+    fields = ("n", "pc", "te", "s")
+    rng = Random(0)
+    for _ in range(50):
+        payload = make_fs_files_payload(rng)
+        data = dumps(payload, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 1])).encode("utf-8")
+        expected = {**payload, "data": [{k: item[k] for k in fields} for item in payload["data"]]}
+        # 随机切分（会切在多字节字符、数字和字符串的中间），也包括逐字节喂入
+        if rng.random() < 0.1:
+            cuts = list(range(1, len(data)))
+        else:
+            cuts = sorted(rng.sample(range(1, len(data)), min(len(data) - 1, rng.randint(1, 64))))
+        parser = video.JSONArrayStreamParser("data", fields)
+        for start, stop in zip([0, *cuts], [*cuts, len(data)]):
+            parser.feed(data[start:stop])
+        assert parser.close() == expected
+
+
+def test_json_array_stream_parser_trailing_number():
+    parser = video.JSONArrayStreamParser("data", ("n",))
+    for chunk in (b'{"data": [], "count": 12', b"34", b"5}"):
+        parser.feed(chunk)
+    assert parser.close() == {"data": [], "count": 12345}
+
+
+@pytest.mark.parametrize("data", [
+    b'{"data": [{"n": "a"}', 
+    b'{"data": [{"n": "a"}, 1]}', 
+    b'{"data": [] "count": 1}', 
+    b'[]', 
+])
+def test_json_array_stream_parser_invalid(data: bytes):
+    parser = video.JSONArrayStreamParser("data", ("n",))
+    with pytest.raises(JSONDecodeError):
+        parser.feed(data)
+        parser.close()
+
+
+@pytest.mark.parametrize("value_width", [4, 18])
+def test_compact_name_index_matches_dict(value_width: int):
+    rng = Random(value_width)
+    index = video.CompactNameIndex(value_width=value_width)
+    ref: dict[str, str] = {}
+    keys = [f"{i}-{i:07d}.mkv" for i in range(3000)] + ["名字.mkv", "", "x" * 300]
+    for _ in range(30000):
+        key = rng.choice(keys)
+        op = rng.random()
+        if op < 0.6:
+            # 包括定长能放下的、超长的和非 ascii 的值
+            value = rng.choice(["pc", "pcabcdefghijklmnop", "长", "a" * 30]) + str(rng.randint(0, 9))
+            index[key] = ref[key] = value
+        elif op < 0.85:
+            if key in ref:
+                del index[key], ref[key]
+            else:
+                with pytest.raises(KeyError):
+                    del index[key]
+        else:
+            assert (key in index) == (key in ref)
+            assert index.get(key) == ref.get(key)
+        assert len(index) == len(ref)
+    assert dict(index.items()) == ref
+    assert sorted(index) == sorted(ref)
+    assert sorted(index.values()) == sorted(ref.values())
+
+
+def test_compact_name_index_drops_deleted_entries_when_growing():
+    index = video.CompactNameIndex()
+    for i in range(20000):
+        index[f"{i}.mkv"] = f"pc{i}"
+    for i in range(0, 20000, 2):
+        del index[f"{i}.mkv"]
+    for i in range(20000, 40000):
+        index[f"{i}.mkv"] = f"pc{i}"
+    assert len(index) == 30000
+    assert index["1.mkv"] == "pc1" and "0.mkv" not in index and index["39999.mkv"] == "pc39999"
+    entries = len(index.table.hashes) + (len(index.old.hashes) if index.old is not None else 0)
+    assert entries < 40000
+
+
+@asynccontextmanager
+async def serve_with_fake_115(
+    bench: ModuleType, 
+    videos: int = 500, 
+    dirs: int = 3, 
+    client_class: None | type = None, 
+    **kwargs, 
+) -> AsyncIterator[tuple[ClientSession, str, str]]:
+    """启动模拟的 115 服务和 302 服务，等目录拉取完成后，产生 (会话, 302 服务的 origin, 模拟的 115 服务的 origin)
+
+    :param bench: 加载的 bench-115-302.py
+    :param client_class: 用来替换 P115Client 的类（FakeP115Client 或者它的子类），默认为 FakeP115Client
+    :param kwargs: 其它参数传给 make_application
+    """
+    if client_class is None:
+        client_class = bench.FakeP115Client
+    port, fake_port = free_port(), free_port()
+    origin, fake_origin = f"http://127.0.0.1:{port}", f"http://127.0.0.1:{fake_port}"
+    video.P115Client = type(client_class.__name__, (client_class,), {"base_url": fake_origin})
+    fake_app = bench.make_fake_115_application(
+        videos=videos, 
+        dirs=dirs, 
+        latency=0, 
+        page_size=64, 
+        base_url=fake_origin, 
+    )
+    app = video.make_application(cids=[str(cid) for cid in range(1, dirs + 1)], interval=inf, **kwargs)
+    fake_server, fake_task = await bench.serve(fake_app, fake_port)
+    server, task = await bench.serve(app, port)
+    try:
+        async with ClientSession(follow_redirects=False) as session:
+            for _ in range(500):
+                if await bench.get_name_cache_size(session, origin) >= videos:
+                    break
+                await sleep(0.01)
+            assert await bench.get_name_cache_size(session, origin) == videos
+            yield session, origin, fake_origin
+    finally:
+        server.should_exit = True
+        await task
+        fake_server.should_exit = True
+        await fake_task
+
+
+@pytest.mark.parametrize("compact_index", [False, True])
+def test_redirect_with_fake_115(bench: ModuleType, compact_index: bool):
+    async def main():
+        async with serve_with_fake_115(bench, compact_index=compact_index, max_bulk_items=4) as (session, origin, fake_origin):
+            resp = await session.get(f"{origin}/2-0000007.mkv")
+            assert resp.status == 302
+            assert resp.get_first_header(b"Location").decode().startswith(f"{fake_origin}/cdn/pc2x7?")
+            resp = await session.get(f"{origin}/", params={"pickcode": "pc3x1"})
+            assert resp.status == 302
+            assert resp.get_first_header(b"Location").decode().startswith(f"{fake_origin}/cdn/pc3x1?")
+            resp = await session.get(f"{origin}/9-0000000.mkv")
+            assert resp.status == 404
+            resp = await session.post(f"{origin}/urls", JSONContent({
+                "names": ["1-0000000.mkv", "9-0000000.mkv"], 
+                "pickcodes": ["pc1x2"], 
+            }))
+            assert resp.status == 200
+            result = loads(await resp.read())["value"]
+            assert result["names"]["1-0000000.mkv"]["url"].startswith(f"{fake_origin}/cdn/pc1x0?")
+            assert result["names"]["9-0000000.mkv"]["state"] is False
+            assert result["pickcodes"]["pc1x2"]["url"].startswith(f"{fake_origin}/cdn/pc1x2?")
+            resp = await session.post(f"{origin}/urls", JSONContent({"names": ["1-0000000.mkv"] * 5}))
+            assert resp.status == 413
+
+    run(main())
+
+
+def test_urls_isolates_failed_items(bench: ModuleType):
+    class MalformedP115Client(bench.FakeP115Client):
+        "pickcode 为 pc1x5 时，返回格式不对的响应，pc1x6 时，抛出网络错误（不可重试）"
+        def download_url_app(self, pickcode: str, /, **request_kwargs):
+            if pickcode == "pc1x5":
+                async def malformed():
+                    return {"state": True, "data": {}}
+                return malformed()
+            elif pickcode == "pc1x6":
+                raise ConnectionRefusedError("simulated")
+            return super().download_url_app(pickcode, **request_kwargs)
+
+    async def main():
+        async with serve_with_fake_115(bench, client_class=MalformedP115Client, retries=0) as (session, origin, fake_origin):
+            resp = await session.post(f"{origin}/urls", JSONContent({
+                "names": ["1-0000000.mkv", "1-0000005.mkv"], 
+                "pickcodes": ["pc1x6", "pc2x1"], 
+            }))
+            assert resp.status == 200
+            result = loads(await resp.read())["value"]
+            assert result["names"]["1-0000000.mkv"]["url"].startswith(f"{fake_origin}/cdn/pc1x0?")
+            assert result["names"]["1-0000005.mkv"]["state"] is False
+            assert result["names"]["1-0000005.mkv"]["status"] == 500
+            assert result["pickcodes"]["pc1x6"]["state"] is False
+            assert result["pickcodes"]["pc1x6"]["status"] == 502
+            assert result["pickcodes"]["pc2x1"]["url"].startswith(f"{fake_origin}/cdn/pc2x1?")
+
+    run(main())
@@ -173,7 +173,7 @@ def initdb(con: Connection | Cursor, /) -> Cursor:
     conn.row_factory = Row
     conn.create_function("escape_name", 1, escape)
     conn.create_function("json_array_head_replace", 3, json_array_head_replace)
-    return con.executescript("""\
+    cur = con.executescript("""\
 PRAGMA journal_mode = WAL;
 
 CREATE TABLE IF NOT EXISTS data (
@@ -218,7 +218,18 @@ END;
 
 CREATE INDEX IF NOT EXISTS idx_data_parent_id ON data(parent_id);
 CREATE INDEX IF NOT EXISTS idx_data_path ON data(path);
+CREATE INDEX IF NOT EXISTS idx_data_name ON data(name);
 """)
+    # 层级深度，即 ancestors 的长度（包含根目录和自身，所以顶层的项目为 2），用来按层罗列子树（servedb.py）
+    # 它是虚拟的生成列，不必在写入时维护，之前创建的表没有这一列，在此补上（生成列要用 table_xinfo 才能查到）
+    if not cur.execute("SELECT 1 FROM pragma_table_xinfo('data') WHERE name = 'depth'").fetchone():
+        cur.execute("""\
+ALTER TABLE data ADD COLUMN depth INTEGER GENERATED ALWAYS AS (
+    CASE WHEN JSON_VALID(ancestors) THEN JSON_ARRAY_LENGTH(ancestors) ELSE 0 END
+) VIRTUAL;""")
+    # 虚拟列也可以建索引（索引中保存了计算好的值），servedb.py 逐层罗列子树时，每一层都是其中连续的一段，不需要排序
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_data_depth_path ON data(depth, path);")
+    return cur
 
 
 def select_ids_to_update(
@@ -27,6 +27,7 @@ TIPS: 请在脚本同一目录下，创建一个 115-cookies.txt 文件，并写
 1. 批量任务：
 
     会周期性地拉取一些指定目录下的所有视频文件的 名字 和 pickcode，并保存到缓存中。批量任务可以被取消。
+    每个目录有各自的轮询间隔，如果目录没有变化，则间隔逐次翻倍（不超过上限），一旦有变化，则重置为最小间隔。
 
 2. 队列任务：
 
@@ -51,9 +52,33 @@ if __name__ == "__main__":
 
     parser = ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
     parser.add_argument("-c", "--cids", metavar="cid", default=["0"], nargs="*", help="待拉取的目录 id，可以传多个，如果不传，默认是根目录")
-    parser.add_argument("-i", "--interval", default=30, type=float, help="前一批任务（拉完所有 cids 算一批）开始拉取，到下一批任务拉取开始，中间至少间隔的秒数，如果时间超过，则立即开始下一批，如果传入 inf 则永久睡眠，默认为 30 秒")
-    parser.add_argument("-f", "--store-file", help="缓存到文件的路径，如果不提供，则在内存中（程序关闭后销毁）")
-    parser.add_argument("-cp", "--cookies-path", default="", help="cookies 文件保存路径，默认是此脚本同一目录下的 115-cookies.txt")
+    parser.add_argument("-i", "--interval", default=30, type=float, help="每个目录前一次开始拉取，到下一次开始拉取，中间至少间隔的秒数（目录有变化时，间隔会重置为此值），如果传入 inf 则永久睡眠，默认为 30 秒")
+    parser.add_argument("-mi", "--max-interval", default=3600, type=float, help="目录没有变化时，它的轮询间隔会逐次翻倍，但不超过此秒数，默认为 3600 秒")
+    parser.add_argument("-w", "--max-workers", default=1, type=int, help="批量任务中，同时拉取的目录数，默认值：1")
+    parser.add_argument("-qw", "--queue-workers", default=1, type=int, help="队列任务中，同时拉取的目录数，默认值：1")
+    parser.add_argument("-f", "--store-file", help="缓存到文件（sqlite 数据库）的路径，如果不提供，则在内存中（程序关闭后销毁）")
+    parser.add_argument("-db", "--dbfile", default="", help="updatedb.py 维护的数据库文件的路径，如果提供，则从中（只读）查询 名字 对应的 pickcode，不再自己拉取目录（-c、-i、-f 等选项无效）")
+    parser.add_argument("-di", "--dbfile-interval", default=1, type=float, help="检查数据库是否有变化（从而清空查询缓存）的间隔秒数，默认值：1")
+    parser.add_argument("-cs", "--cache-size", default=1024, type=int, help="直链缓存的最大条数（按 pickcode 和 User-Agent 区分，会在直链过期前失效），如果 <= 0 则不缓存，默认值：1024")
+    parser.add_argument("-ci", "--compact-index", action="store_true", help="用紧凑的结构在内存中保存 名字 到 pickcode 的映射（比 dict 省很多内存，但查找稍慢），适合有数百万个视频的情况")
+    parser.add_argument("-pu", "--prefetch-user-agent", metavar="user_agent", default=[], nargs="*", help="增量拉取时新发现的视频，会在后台为这些 User-Agent 预先获取直链并放入缓存（需要启用直链缓存），可以传多个（空字符串表示不带 User-Agent），默认不预先获取")
+    parser.add_argument("-ra", "--refresh-ahead", default=0, type=float, help="缓存中的直链如果距离失效不足这么多秒，则先返回缓存中的直链，同时在后台刷新，如果 <= 0 则不提前刷新，默认值：0")
+    parser.add_argument("-hm", "--head-meta", action="store_true", help="拉取目录时，在内存中记录视频的文件大小和更新时间，用于回答 HEAD 请求（在 X-File-Size 和 Last-Modified 响应头中），使用 -db 时总是可用")
+    parser.add_argument("-cp", "--cookies-path", default=[], nargs="*", help="cookies 文件保存路径，可以传多个（即多个账号，获取直链时会轮流使用），默认是此脚本同一目录下的 115-cookies.txt")
+    parser.add_argument("-r", "--rate", default=0, type=float, help="所有账号合计，每秒最多调用 115 接口的次数（获取直链优先于拉取目录），如果 <= 0 则不限制，默认值：0")
+    parser.add_argument("-b", "--burst", default=10, type=int, help="所有账号合计，允许突发调用 115 接口的次数，默认值：10")
+    parser.add_argument("-rt", "--retries", default=3, type=int, help="调用 115 接口时，如果被限流或遇到临时性错误（超时、网络错误、服务端错误），最多重试的次数，默认值：3")
+    parser.add_argument("-ar", "--account-rate", default=0, type=float, help="获取直链时，每个账号每秒最多调用接口的次数，如果 <= 0 则不限制，默认值：0")
+    parser.add_argument("-ab", "--account-burst", default=5, type=int, help="获取直链时，每个账号允许突发调用接口的次数，默认值：5")
+    parser.add_argument("-ae", "--account-eject", default=60, type=float, help="获取直链时，如果某个账号出错（例如被限流或需要重新登录），则暂停使用它这么多秒，默认值：60")
+    parser.add_argument("-mc", "--max-concurrency", default=0, type=int, help="获取直链的路由，全局最多同时处理的请求数，如果 <= 0 则不限制，默认值：0")
+    parser.add_argument("-mcc", "--max-client-concurrency", default=0, type=int, help="获取直链的路由，每个客户端（按 ip 区分）最多同时处理的请求数，如果 <= 0 则不限制，默认值：0")
+    parser.add_argument("-aq", "--admission-queue", default=100, type=int, help="超过并发数限制时，最多排队等待的请求数，超出则返回 429，默认值：100")
+    parser.add_argument("-at", "--admission-timeout", default=5, type=float, help="超过并发数限制时，排队等待的最长秒数，超时则返回 429，默认值：5")
+    parser.add_argument("-cr", "--client-rate", default=0, type=float, help="获取直链的路由，每个客户端（按 ip 区分）每秒最多的请求数，超出则返回 429，如果 <= 0 则不限制，默认值：0")
+    parser.add_argument("-cb", "--client-burst", default=10, type=int, help="获取直链的路由，每个客户端允许突发的请求数，默认值：10")
+    parser.add_argument("-mb", "--max-bulk-items", default=100, type=int, help="批量获取直链（POST /urls）时，每个请求最多包含的条目数，超出则返回 413，默认值：100")
+    parser.add_argument("-al", "--access-log", default="", help="访问日志（每行是一个 JSON 对象，包括各个阶段的耗时、缓存命中情况和 115 接口的耗时）的输出路径，如果为 - 则输出到 stdout，如果不提供则不记录")
     parser.add_argument("-p", "--password", help="执行 POST 请求所需密码")
     parser.add_argument("-t", "--token", default="", help="用于给链接进行签名的 token，如果不提供则无签名")
     parser.add_argument("-H", "--host", default="0.0.0.0", help="ip 或 hostname，默认值：'0.0.0.0'")
@@ -67,8 +92,20 @@ if __name__ == "__main__":
 
 try:
     from p115client import P115Client
-    from blacksheep import json, redirect, text, Application, FromJSON, Request, Router
+except ImportError:
+    if __name__ == "__main__":
+        from sys import executable
+        from subprocess import run
+        run([executable, "-m", "pip", "install", "-U", "p115client"], check=True)
+        from p115client import P115Client
+    else:
+        # 被其它模块加载（例如测试）时不自动安装，P115Client 只在 make_application 中用到，加载者可以替换为别的实现
+        P115Client = None # type: ignore
+
+try:
+    from blacksheep import json, redirect, text, Application, Content, FromJSON, Request, Response, Router
     from blacksheep.client import ClientSession
+    from blacksheep.exceptions import HTTPException
     from blacksheep.server.openapi.common import ParameterInfo
     from blacksheep.server.openapi.ui import ReDocUIProvider
     from blacksheep.server.openapi.v3 import OpenAPIHandler
@@ -79,9 +116,9 @@ except ImportError:
     from sys import executable
     from subprocess import run
     run([executable, "-m", "pip", "install", "-U", *__requirements__], check=True)
-    from p115client import P115Client
-    from blacksheep import json, redirect, text, Application, FromJSON, Request, Router
+    from blacksheep import json, redirect, text, Application, Content, FromJSON, Request, Response, Router
     from blacksheep.client import ClientSession
+    from blacksheep.exceptions import HTTPException
     from blacksheep.server.openapi.common import ParameterInfo
     from blacksheep.server.openapi.ui import ReDocUIProvider
     from blacksheep.server.openapi.v3 import OpenAPIHandler
@@ -91,41 +128,1000 @@ except ImportError:
 
 import logging
 
-from asyncio import create_task, sleep, CancelledError, Queue
-from collections.abc import Iterable, Iterator, MutableMapping, Sequence
-from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+from array import array
+from asyncio import (
+    create_task, gather, get_running_loop, shield, sleep, to_thread, wait, 
+    CancelledError, Future, Queue, Semaphore, Task, TimerHandle, FIRST_COMPLETED, 
+)
+from bisect import bisect_left
+from codecs import getincrementaldecoder
+from collections import defaultdict, deque, Counter, OrderedDict
+from collections.abc import Awaitable, Callable, Iterable, Iterator, Mapping, MutableMapping, Sequence
+from contextlib import contextmanager, AsyncExitStack
+from contextvars import ContextVar
+from email.utils import formatdate
+from errno import EAGAIN, ENOENT
 from hashlib import sha1
-from math import isinf, isnan, nan
+from heapq import heappop, heappush
+from itertools import count, takewhile
+from json import dumps, JSONDecodeError, JSONDecoder
+from math import ceil, inf, isinf, isnan, nan
 from pathlib import Path
-from time import time
+from queue import SimpleQueue
+from random import uniform
+from re import compile as re_compile
+from sqlite3 import connect, Connection
+from sys import _current_frames, getsizeof, stdout
+from threading import get_ident
+from time import monotonic, perf_counter, sleep as sleep_sync, time
+from typing import Any
+from urllib.parse import parse_qsl, urlsplit
+from zlib import decompressobj, MAX_WBITS
+
+
+class SQLiteMap(MutableMapping[str, str]):
+    """以 sqlite 数据库中的一张表作为持久化存储的映射，读取全部走启动时构建的内存字典
+
+    :param con: 数据库连接
+    :param table: 表名，如果不存在则自动创建，有 key 和 value 两列
+    :param data: 内存中的映射（例如 CompactNameIndex），如果不提供，则是 dict
+    """
+
+    def __init__(self, con: Connection, /, table: str, data: None | MutableMapping[str, str] = None):
+        self.con = con
+        self.table = table
+        con.execute(f"""\
+CREATE TABLE IF NOT EXISTS {table} (
+    key TEXT NOT NULL PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;""")
+        con.commit()
+        if data is None:
+            self.data: MutableMapping[str, str] = dict(con.execute(f"SELECT key, value FROM {table}"))
+        else:
+            data.update(con.execute(f"SELECT key, value FROM {table}"))
+            self.data = data
+
+    def __contains__(self, key, /) -> bool:
+        return key in self.data
+
+    def __delitem__(self, key: str, /):
+        del self.data[key]
+        with self.con:
+            self.con.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def __getitem__(self, key: str, /) -> str:
+        return self.data[key]
+
+    def __iter__(self, /) -> Iterator[str]:
+        return iter(self.data)
+
+    def __len__(self, /) -> int:
+        return len(self.data)
+
+    def __setitem__(self, key: str, value: str, /):
+        if self.data.get(key) == value:
+            return
+        with self.con:
+            self.con.execute(f"REPLACE INTO {self.table}(key, value) VALUES (?, ?)", (key, value))
+        self.data[key] = value
+
+    def update(self, other: Any = (), /, **kwargs: str) -> None:
+        """批量写入，只写入有变化的条目，并且在同一个事务中提交
+
+        和 MutableMapping.update 一样，接受映射、有 keys 方法的对象、(key, value) 的可迭代对象，以及关键字参数
+        """
+        if isinstance(other, Mapping):
+            pairs: Iterable[tuple[str, str]] = other.items()
+        elif hasattr(other, "keys"):
+            pairs = ((k, other[k]) for k in other.keys())
+        else:
+            pairs = other
+        get = self.data.get
+        items = {k: v for k, v in pairs if get(k) != v}
+        items.update((k, v) for k, v in kwargs.items() if get(k) != v)
+        if not items:
+            return
+        with self.con:
+            self.con.executemany(f"REPLACE INTO {self.table}(key, value) VALUES (?, ?)", items.items())
+        self.data.update(items)
+
+
+class CompactNameTable:
+    """CompactNameIndex 中的一代数据，哈希表的容量固定，由 CompactNameIndex 负责扩容
+
+    名字（utf-8 编码）依次追加到同一个 bytearray 中，pickcode（ascii）以定长字节保存，
+    再用一个开放寻址的哈希表（只保存条目的序号）进行查找，每条数据只占用几十个字节。
+    被删除的条目不会回收空间，直到扩容时迁移到下一代。
+
+    :param capacity: 哈希表的容量，必须是 2 的幂
+    :param value_width: pickcode 的定长字节数，更长的（或者不是 ascii 的）值另外保存在一个字典中
+    """
+    EMPTY = 0xFFFF_FFFF
+    DELETED = 0xFFFF_FFFE
+
+    def __init__(self, /, capacity: int = 8, value_width: int = 18):
+        self.value_width = value_width
+        # 所有名字依次拼接，第 j 个条目的名字是 arena[offsets[j]:offsets[j+1]]
+        self.arena = bytearray()
+        self.offsets = array("Q", [0])
+        # 第 j 个条目的名字的哈希值（低 32 位）
+        self.hashes = array("I")
+        # 第 j 个条目的值是 value_bytes[j*value_width:(j+1)*value_width]，不足部分用 b"\0" 填充
+        self.value_bytes = bytearray()
+        self.overflow: dict[int, str] = {}
+        self.deleted: set[int] = set()
+        # 哈希表，保存条目序号，或者 EMPTY、DELETED
+        self.slots = array("I", [self.EMPTY]) * capacity
+        self.filled = 0
+
+    def __len__(self, /) -> int:
+        return len(self.hashes) - len(self.deleted)
+
+    def find(self, data: bytes | bytearray, h: int, /) -> tuple[int, int]:
+        "返回 (槽位, 条目序号)，如果不存在，则条目序号为 -1，槽位为可用于插入的位置"
+        slots, arena, offsets, hashes = self.slots, self.arena, self.offsets, self.hashes
+        mask = len(slots) - 1
+        i = h & mask
+        perturb = h
+        free = -1
+        while True:
+            j = slots[i]
+            if j == self.EMPTY:
+                return (i if free < 0 else free), -1
+            if j == self.DELETED:
+                if free < 0:
+                    free = i
+            elif hashes[j] == h and arena[offsets[j]:offsets[j+1]] == data:
+                return i, j
+            perturb >>= 5
+            i = (i * 5 + perturb + 1) & mask
+
+    def get_key(self, j: int, /) -> str:
+        return self.arena[self.offsets[j]:self.offsets[j+1]].decode("utf-8")
+
+    def get_value(self, j: int, /) -> str:
+        if j in self.overflow:
+            return self.overflow[j]
+        width = self.value_width
+        return self.value_bytes[j*width:(j+1)*width].rstrip(b"\0").decode("ascii")
+
+    def set_value(self, j: int, value: str, /):
+        if not isinstance(value, str):
+            raise TypeError(f"value must be str, got {type(value).__qualname__}")
+        width = self.value_width
+        if len(value) > width or not value.isascii() or value.endswith("\0"):
+            self.overflow[j] = value
+            value = ""
+        else:
+            self.overflow.pop(j, None)
+        self.value_bytes[j*width:(j+1)*width] = value.encode("ascii").ljust(width, b"\0")
+
+    def append(self, i: int, data: bytes | bytearray, h: int, value: str, /) -> int:
+        "把新条目放在槽位 i（由 find 返回），返回条目序号"
+        j = len(self.hashes)
+        if j >= self.DELETED:
+            raise OverflowError("too many entries")
+        self.value_bytes += bytes(self.value_width)
+        self.set_value(j, value)
+        self.arena += data
+        self.offsets.append(len(self.arena))
+        self.hashes.append(h)
+        if self.slots[i] == self.EMPTY:
+            self.filled += 1
+        self.slots[i] = j
+        return j
+
+    def delete(self, i: int, j: int, /):
+        self.slots[i] = self.DELETED
+        self.deleted.add(j)
+        self.overflow.pop(j, None)
+
+    def is_full(self, /) -> bool:
+        "装载率（包括已删除的槽位）是否达到 2/3"
+        return self.filled * 3 >= len(self.slots) * 2
+
+    def memory_usage(self, /) -> int:
+        return sum(map(getsizeof, (
+            self.arena, self.offsets, self.hashes, self.value_bytes, self.slots, self.overflow, self.deleted, 
+        )))
+
+
+class CompactNameIndex(MutableMapping[str, str]):
+    """紧凑的 名字 到 pickcode 的映射，用于代替 dict，以便在内存中保存数百万条数据（数据结构见 CompactNameTable）
+
+    扩容是渐进的：装满时新建一个更大的 CompactNameTable 接收新条目，之后每次写入时，
+    从旧的那一代迁移至多 MIGRATE_STEP 个（未被删除的）条目，所以单次写入的耗时有上限，不会长时间阻塞事件循环。
+    迁移期间，查找会依次检查新旧两代，迁移完成后，旧的那一代（连同已删除的条目）被丢弃。
+
+    :param value_width: pickcode 的定长字节数，更长的（或者不是 ascii 的）值另外保存在一个字典中
+    """
+    MIGRATE_STEP = 256
+
+    def __init__(self, /, value_width: int = 18):
+        self.value_width = value_width
+        self.table = CompactNameTable(8, value_width)
+        # 正在迁移的旧的那一代，其中序号小于 cursor 的条目已经迁移
+        self.old: None | CompactNameTable = None
+        self.cursor = 0
+        self.size = 0
+
+    def _find(self, data: bytes, h: int, /) -> tuple[CompactNameTable, int, int]:
+        "返回 (所在的那一代, 槽位, 条目序号)，如果不存在，则条目序号为 -1，槽位为新的那一代中可用于插入的位置"
+        table = self.table
+        i, j = table.find(data, h)
+        if j < 0 and (old := self.old) is not None:
+            oi, oj = old.find(data, h)
+            # 序号小于 cursor 的已经迁移（如果在新的那一代中找不到，说明迁移后又被删除了）
+            if oj >= self.cursor:
+                return old, oi, oj
+        return table, i, j
+
+    def _migrate(self, /, step: int = MIGRATE_STEP):
+        "从旧的那一代迁移至多 step 个条目到新的那一代"
+        if (old := self.old) is None:
+            return
+        table = self.table
+        arena, offsets, hashes, deleted = old.arena, old.offsets, old.hashes, old.deleted
+        stop = min(self.cursor + step, len(hashes))
+        for j in range(self.cursor, stop):
+            if j in deleted:
+                continue
+            data, h = arena[offsets[j]:offsets[j+1]], hashes[j]
+            table.append(table.find(data, h)[0], data, h, old.get_value(j))
+        self.cursor = stop
+        if stop >= len(hashes):
+            self.old = None
+            self.cursor = 0
+
+    def _grow(self, /):
+        "新建一个装载率不超过 1/3 的新一代，开始渐进的迁移"
+        if (old := self.old) is not None:
+            # 上一次的迁移还没完成（很少发生），先一次性完成
+            self._migrate(len(old.hashes))
+        capacity = 8
+        while capacity < self.size * 3:
+            capacity *= 2
+        self.old = self.table
+        self.table = CompactNameTable(capacity, self.value_width)
+        self.cursor = 0
+        self._migrate()
+
+    def __contains__(self, key, /) -> bool:
+        if not isinstance(key, str):
+            return False
+        return self._find(key.encode("utf-8"), hash(key) & 0xFFFF_FFFF)[2] >= 0
+
+    def __delitem__(self, key: str, /):
+        if not isinstance(key, str):
+            raise KeyError(key)
+        table, i, j = self._find(key.encode("utf-8"), hash(key) & 0xFFFF_FFFF)
+        if j < 0:
+            raise KeyError(key)
+        table.delete(i, j)
+        self.size -= 1
+        self._migrate()
+
+    def __getitem__(self, key: str, /) -> str:
+        if not isinstance(key, str):
+            raise KeyError(key)
+        table, _, j = self._find(key.encode("utf-8"), hash(key) & 0xFFFF_FFFF)
+        if j < 0:
+            raise KeyError(key)
+        return table.get_value(j)
+
+    def __iter__(self, /) -> Iterator[str]:
+        for table, start in ((self.table, 0), (self.old, self.cursor)):
+            if table is None:
+                continue
+            deleted = table.deleted
+            for j in range(start, len(table.hashes)):
+                if j not in deleted:
+                    yield table.get_key(j)
+
+    def __len__(self, /) -> int:
+        return self.size
+
+    def __setitem__(self, key: str, value: str, /):
+        if not isinstance(key, str):
+            raise TypeError(f"key must be str, got {type(key).__qualname__}")
+        data, h = key.encode("utf-8"), hash(key) & 0xFFFF_FFFF
+        table, i, j = self._find(data, h)
+        if j >= 0:
+            table.set_value(j, value)
+            return
+        self.table.append(i, data, h, value)
+        self.size += 1
+        self._migrate()
+        if self.table.is_full():
+            self._grow()
+
+    def clear(self, /):
+        self.__init__(self.value_width) # type: ignore
+
+    def memory_usage(self, /) -> int:
+        "估算占用的字节数（不包括 overflow 和 deleted 中的对象）"
+        return sum(table.memory_usage() for table in (self.table, self.old) if table is not None)
+
+
+class SQLiteNameIndex(Mapping[str, str]):
+    """以 updatedb.py 维护的数据库中的 data 表作为 名字 到 pickcode 的（只读）映射
+
+    查询走 idx_data_name 索引（由 updatedb.py 创建），结果（包括未找到）缓存在内存中，
+    调用 refresh 时，如果 PRAGMA data_version 有变化（即有其它连接提交了写入），则清空缓存。
+    如果有多个文件同名，则取更新时间最近的那个。
+
+    :param dbfile: 数据库文件路径，以只读方式打开
+    :param cache_size: 缓存的最大条数
+    """
+
+    def __init__(self, dbfile: str | Path, /, cache_size: int = 65536):
+        self.uri = f"{Path(dbfile).absolute().as_uri()}?mode=ro"
+        self.con = connect(self.uri, uri=True, check_same_thread=False)
+        self.cache_size = cache_size
+        self.cache: OrderedDict[str, None | str] = OrderedDict()
+        # 最近一次统计的名字数目，-1 表示还没统计过
+        self.length = -1
+        self.data_version = self.get_data_version()
+
+    def get_data_version(self, /) -> int:
+        return self.con.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh(self, /) -> bool:
+        "如果数据库有变化，则清空缓存并返回 True"
+        data_version = self.get_data_version()
+        if data_version == self.data_version:
+            return False
+        self.data_version = data_version
+        self.cache.clear()
+        return True
+
+    def close(self, /):
+        self.con.close()
+
+    def __getitem__(self, key: str, /) -> str:
+        cache = self.cache
+        try:
+            value = cache[key]
+            cache.move_to_end(key)
+        except KeyError:
+            row = self.con.execute(
+                "SELECT pickcode FROM data WHERE name = ? AND NOT is_dir AND pickcode != '' ORDER BY mtime DESC LIMIT 1",
+                (key,),
+            ).fetchone()
+            value = cache[key] = row[0] if row else None
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get_meta(self, key: str, /) -> None | tuple[int, int]:
+        "获取 (文件大小, 更新时间)，如果不存在则返回 None（不经过缓存）"
+        return self.con.execute(
+            "SELECT size, mtime FROM data WHERE name = ? AND NOT is_dir AND pickcode != '' ORDER BY mtime DESC LIMIT 1",
+            (key,),
+        ).fetchone()
+
+    def __iter__(self, /) -> Iterator[str]:
+        for name, in self.con.execute("SELECT DISTINCT name FROM data WHERE NOT is_dir AND pickcode != ''"):
+            yield name
+
+    def count(self, /) -> int:
+        "统计名字的数目，需要扫描整个表，所以使用单独的连接，可以在其它线程中调用"
+        con = connect(self.uri, uri=True)
+        try:
+            return con.execute("SELECT COUNT(DISTINCT name) FROM data WHERE NOT is_dir AND pickcode != ''").fetchone()[0]
+        finally:
+            con.close()
+
+    def __len__(self, /) -> int:
+        # 返回最近一次统计的结果（数据库变化后，由调用方在其它线程中重新统计），只有从未统计过时才当场统计
+        if self.length < 0:
+            self.length = self.count()
+        return self.length
+
+
+class Histogram:
+    """Prometheus 风格的直方图，用于统计耗时
+
+    :param buckets: 各个分桶的上界（升序），最后还有一个 +Inf 分桶
+    """
+
+    def __init__(
+        self, 
+        /, 
+        buckets: Sequence[float] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), 
+    ):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float, /):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def expose(self, name: str, /, **labels: str) -> Iterator[str]:
+        "输出 Prometheus 文本格式的若干行"
+        total = 0
+        for le, n in zip((*map(str, self.buckets), "+Inf"), self.counts):
+            total += n
+            yield f"{name}_bucket{format_labels(**labels, le=le)} {total}"
+        yield f"{name}_sum{format_labels(**labels)} {self.sum}"
+        yield f"{name}_count{format_labels(**labels)} {self.count}"
+
+
+def format_labels(**labels: str) -> str:
+    "把标签格式化为 Prometheus 文本格式"
+    if not labels:
+        return ""
+    def escape(value: str, /) -> str:
+        return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+    return "{%s}" % ",".join(f'{k}="{escape(str(v))}"' for k, v in labels.items())
+
+
+def sample_stacks(thread_id: int, /, seconds: float, interval: float = 0.005) -> Counter[str]:
+    """每隔 interval 秒对某个线程的调用栈采样一次，持续 seconds 秒（需要在另一个线程中运行）
+
+    :return: 折叠格式的调用栈（从外到内，以 ; 分隔）对应的采样次数，可以用 flamegraph.pl 或 speedscope 生成火焰图
+    """
+    stacks: Counter[str] = Counter()
+    stop = perf_counter() + seconds
+    while perf_counter() < stop:
+        frame = _current_frames().get(thread_id)
+        names: list[str] = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})".replace(";", ":"))
+            frame = frame.f_back
+        del frame
+        if names:
+            stacks[";".join(reversed(names))] += 1
+        sleep_sync(interval)
+    return stacks
+
+
+class TokenBucket:
+    """令牌桶，用于限制调用频率
+
+    :param rate: 每秒补充的令牌数，如果 <= 0，则不限制
+    :param burst: 桶的容量，即允许突发调用的次数
+    """
+
+    def __init__(self, /, rate: float = 0, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = monotonic()
+
+    def refill(self, /) -> float:
+        "补充令牌，返回当前的令牌数"
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def delay(self, n: int = 1, /) -> float:
+        "还需要等待多少秒，才有 n 个令牌（最多按桶的容量计）"
+        if self.rate <= 0:
+            return 0
+        n = min(n, self.burst)
+        tokens = self.refill()
+        return 0 if tokens >= n else (n - tokens) / self.rate
+
+    def take(self, n: int = 1, /) -> bool:
+        """尝试取走 n 个令牌，返回是否成功
+
+        n 超过桶的容量时，只要桶是满的就能取走，令牌数变为负数，之后要等补足了欠下的令牌才能再取
+        """
+        if self.rate <= 0:
+            return True
+        if self.refill() >= min(n, self.burst):
+            self.tokens -= n
+            return True
+        return False
+
+
+class RateLimiter:
+    """带优先级的异步限流器，令牌不足时排队，优先级的数值越小，越先获得令牌
+
+    :param rate: 每秒最多放行的次数，如果 <= 0，则不限制
+    :param burst: 允许突发放行的次数
+    """
+
+    def __init__(self, /, rate: float = 0, burst: int = 1):
+        self.bucket = TokenBucket(rate, burst)
+        self.waiters: list[tuple[int, int, Future]] = []
+        self.counter = count()
+        self.timer: None | TimerHandle = None
+
+    async def acquire(self, /, priority: int = 0):
+        "获取 1 个令牌，如果没有，则按优先级排队等待"
+        if not self.waiters and self.bucket.take():
+            return
+        future = get_running_loop().create_future()
+        heappush(self.waiters, (priority, next(self.counter), future))
+        if self.timer is None:
+            self.wakeup()
+        await future
+
+    def wakeup(self, /):
+        "按优先级放行等待者，直到令牌用完，然后在下一个令牌到来时再次执行"
+        self.timer = None
+        waiters = self.waiters
+        while waiters:
+            future = waiters[0][2]
+            if future.done():
+                heappop(waiters)
+            elif self.bucket.take():
+                heappop(waiters)
+                future.set_result(None)
+            else:
+                break
+        if waiters:
+            self.timer = get_running_loop().call_later(self.bucket.delay(), self.wakeup)
+
+
+def is_transient_error(e: BaseException, /) -> bool:
+    "判断是否是可以重试的错误：被限流（HTTP 405 或 429）、服务端错误（HTTP 5xx）、超时或网络错误"
+    if isinstance(e, HTTPException):
+        return e.status in (405, 429) or e.status >= 500
+    return isinstance(e, OSError) and not isinstance(
+        e, (FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError))
+
+
+# 115 接口（state 为 false 时）表示需要重新登录（99、990001）或者需要验证（911）的 errno
+ACCOUNT_ERRNOS = frozenset((99, 911, 990001))
+# 115 接口（state 为 false 时）的错误信息中，表示被限流、需要重新登录或者需要验证的关键字
+ACCOUNT_ERROR_KEYWORDS = ("频繁", "登录", "验证")
+
+
+class AccountUnavailableError(OSError):
+    "账号被限流、需要重新登录或者需要验证，第 2 个参数是接口的响应"
+
+
+def is_account_error(resp: dict, /) -> bool:
+    "判断 115 接口的失败响应，是否是因为账号被限流、需要重新登录或者需要验证（换一个账号可能就会成功）"
+    if resp.get("state"):
+        return False
+    try:
+        if int(resp.get("errno") or resp.get("code") or 0) in ACCOUNT_ERRNOS:
+            return True
+    except (TypeError, ValueError):
+        pass
+    message = str(resp.get("error") or resp.get("msg") or resp.get("message") or "")
+    return any(keyword in message for keyword in ACCOUNT_ERROR_KEYWORDS)
+
+
+skip_json_ws = re_compile(r"[ \t\n\r]*").match
+
+
+class JSONArrayStreamParser:
+    """增量解析一个 JSON 对象（可以分多次喂入字节数据），其中 array_key 对应的数组会逐项解析，每项只保留 fields 中的字段
+
+    其它键对应的值会被完整解析，所以只适用于除了这个数组以外，其它部分都很小的情况（例如 fs_files 接口的响应）
+
+    :param array_key: 需要逐项解析的数组所对应的键
+    :param fields: 数组中的每一项（是 JSON 对象）需要保留的字段
+    """
+    START, KEY_OR_END, COLON, VALUE, ITEM_OR_END, ITEM_SEP, SEP, DONE = range(8)
+
+    def __init__(self, /, array_key: str = "data", fields: Sequence[str] = ("n", "pc", "te", "s")):
+        self.array_key = array_key
+        self.fields = fields
+        self.decoder = getincrementaldecoder("utf-8")()
+        self.raw_decode = JSONDecoder().raw_decode
+        self.buf = ""
+        self.state = self.START
+        self.key = ""
+        self.result: dict = {}
+
+    def feed(self, data: bytes, /, final: bool = False):
+        "喂入一块数据，如果 final 为 True，则表示这是最后一块"
+        buf = self.buf = self.buf + self.decoder.decode(data, final)
+        raw_decode = self.raw_decode
+        n = len(buf)
+        pos = 0
+        while (pos := skip_json_ws(buf, pos).end()) < n:
+            state = self.state
+            c = buf[pos]
+            # 键、数组中的项、其它键的值，直接用 json 模块解析
+            if state == self.KEY_OR_END:
+                decode = c == '"'
+            elif state == self.VALUE:
+                decode = not (self.key == self.array_key and c == "[")
+            else:
+                decode = state == self.ITEM_OR_END and c != "]"
+            if decode:
+                try:
+                    value, end = raw_decode(buf, pos)
+                except JSONDecodeError:
+                    # 数据不完整，等待下一块
+                    if final:
+                        raise
+                    break
+                # 数字后面如果没有分隔符，可能还没有接收完整
+                if (not final and isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and (end == n or buf[end] not in " \t\n\r,]}")):
+                    break
+                pos = end
+                if state == self.KEY_OR_END:
+                    self.key = value
+                    self.state = self.COLON
+                elif state == self.VALUE:
+                    self.result[self.key] = value
+                    self.state = self.SEP
+                else:
+                    if not isinstance(value, dict):
+                        raise JSONDecodeError(f"expect an object in {self.array_key!r}", buf, pos)
+                    self.result[self.array_key].append({k: value[k] for k in self.fields if k in value})
+                    self.state = self.ITEM_SEP
+                continue
+            match state, c:
+                case self.START, "{":
+                    self.state = self.KEY_OR_END
+                case (self.KEY_OR_END, "}") | (self.SEP, "}"):
+                    self.state = self.DONE
+                case self.COLON, ":":
+                    self.state = self.VALUE
+                case self.VALUE, "[":
+                    self.result[self.key] = []
+                    self.state = self.ITEM_OR_END
+                case (self.ITEM_OR_END, "]") | (self.ITEM_SEP, "]"):
+                    self.state = self.SEP
+                case self.ITEM_SEP, ",":
+                    self.state = self.ITEM_OR_END
+                case self.SEP, ",":
+                    self.state = self.KEY_OR_END
+                case _:
+                    raise JSONDecodeError("unexpected character", buf, pos)
+            pos += 1
+        self.buf = buf[pos:]
+        if final and self.state != self.DONE:
+            raise JSONDecodeError("unexpected end of data", buf, len(buf))
+
+    def close(self, /) -> dict:
+        "结束解析，返回结果"
+        self.feed(b"", final=True)
+        return self.result
+
+
+async def parse_fs_files_stream(resp, /) -> dict:
+    "边接收边解析 fs_files 接口的响应体，数据中的每一项只保留 n、pc、te 和 s 字段，以免一次性占用大量内存"
+    parser = JSONArrayStreamParser("data", ("n", "pc", "te", "s"))
+    match resp.headers.get("Content-Encoding", ""):
+        case "gzip" | "deflate":
+            decompress = decompressobj(MAX_WBITS | 32).decompress
+        case "br":
+            from brotli import Decompressor # type: ignore
+            decompress = Decompressor().process
+        case "zstd":
+            from zstandard import ZstdDecompressor # type: ignore
+            decompress = ZstdDecompressor().decompressobj().decompress
+        case _:
+            decompress = bytes
+    async for chunk in resp.response.stream():
+        parser.feed(decompress(chunk))
+    return parser.close()
+
+
+async def request_fs_files_stream(url: str, method: str = "GET", parse=None, **request_kwargs) -> dict:
+    "代替 blacksheep_request 来调用 fs_files 接口，会忽略传入的 parse，改用 parse_fs_files_stream 解析响应"
+    return await blacksheep_request(url, method, parse=parse_fs_files_stream, **request_kwargs)
+
+
+class P115ClientPool:
+    """多个账号的客户端池，每次选取未被暂停且有令牌的账号中，最久未被使用的那个
+
+    :param clients: 各个账号的客户端
+    :param rate: 每个账号每秒最多调用的次数，如果 <= 0，则不限制
+    :param burst: 每个账号允许突发调用的次数
+    :param eject_seconds: 账号出错后，暂停使用的秒数
+    """
+
+    def __init__(
+        self, 
+        /, 
+        clients: Iterable[P115Client], 
+        rate: float = 0, 
+        burst: int = 1, 
+        eject_seconds: float = 60, 
+    ):
+        self.clients = list(clients)
+        if not self.clients:
+            raise ValueError("no clients specified")
+        self.buckets = [TokenBucket(rate, burst) for _ in self.clients]
+        self.last_used = [0.0] * len(self.clients)
+        self.ejected_until = [0.0] * len(self.clients)
+        self.eject_seconds = eject_seconds
+
+    async def acquire(self, /) -> int:
+        "选取一个账号，返回它的索引，如果都没有令牌，则等待"
+        while True:
+            now = monotonic()
+            indexes = range(len(self.clients))
+            # 如果都被暂停了，则不考虑暂停
+            candidates = [i for i in indexes if self.ejected_until[i] <= now] or list(indexes)
+            candidates.sort(key=self.last_used.__getitem__)
+            for i in candidates:
+                if self.buckets[i].take():
+                    self.last_used[i] = now
+                    return i
+            await sleep(min(self.buckets[i].delay() for i in candidates))
+
+    def eject(self, index: int, /):
+        "暂停使用某个账号一段时间"
+        self.ejected_until[index] = monotonic() + self.eject_seconds
+
+    def restore(self, index: int, /):
+        "恢复使用某个账号"
+        self.ejected_until[index] = 0
+
+    def status(self, /) -> list[dict]:
+        now = monotonic()
+        return [
+            {
+                "index": i, 
+                "ejected": max(0, self.ejected_until[i] - now), 
+                "idle": now - self.last_used[i] if self.last_used[i] else None, 
+                "tokens": self.buckets[i].refill() if self.buckets[i].rate > 0 else None, 
+            }
+            for i in range(len(self.clients))
+        ]
+
+
+class AdmissionController:
+    """准入控制，限制全局和每个客户端（按 ip 区分）同时处理的请求数，以及每个客户端的请求频率
+
+    超过并发数限制的请求按到达顺序排队，队列已满或者等待超时则被拒绝，超过频率限制的请求直接被拒绝
+
+    :param limit: 全局最多同时处理的请求数，如果 <= 0，则不限制
+    :param client_limit: 每个客户端最多同时处理的请求数，如果 <= 0，则不限制
+    :param queue_size: 最多排队等待的请求数
+    :param timeout: 排队等待的最长秒数
+    :param client_rate: 每个客户端每秒最多的请求数，如果 <= 0，则不限制
+    :param client_burst: 每个客户端允许突发的请求数
+    """
+
+    def __init__(
+        self, 
+        /, 
+        limit: int = 0, 
+        client_limit: int = 0, 
+        queue_size: int = 0, 
+        timeout: float = 5, 
+        client_rate: float = 0, 
+        client_burst: int = 10, 
+    ):
+        self.limit = limit
+        self.client_limit = client_limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.active = 0
+        self.client_active: dict[str, int] = {}
+        self.waiters: deque[tuple[str, Future]] = deque()
+        self.buckets: dict[str, TokenBucket] = {}
+        self.stat = {"admitted": 0, "queued": 0, "shed_queue_full": 0, "shed_timeout": 0, "shed_rate": 0}
+
+    @property
+    def enabled(self, /) -> bool:
+        return self.limit > 0 or self.client_limit > 0 or self.client_rate > 0
+
+    def can_admit(self, client: str, /) -> bool:
+        return ((self.limit <= 0 or self.active < self.limit) and
+                (self.client_limit <= 0 or self.client_active.get(client, 0) < self.client_limit))
+
+    def admit(self, client: str, /):
+        self.active += 1
+        self.client_active[client] = self.client_active.get(client, 0) + 1
+        self.stat["admitted"] += 1
+
+    def take_token(self, client: str, n: int = 1, /) -> float:
+        "从客户端的令牌桶中取走 n 个令牌，成功时返回 0，否则返回还需要等待的秒数"
+        if self.client_rate <= 0:
+            return 0
+        try:
+            bucket = self.buckets[client]
+        except KeyError:
+            # 客户端太多时，先清理掉已经装满（即最近没有请求）的令牌桶
+            if len(self.buckets) >= 65536:
+                self.buckets = {k: b for k, b in self.buckets.items() if b.refill() < b.burst}
+            bucket = self.buckets[client] = TokenBucket(self.client_rate, self.client_burst)
+        if bucket.take(n):
+            return 0
+        return bucket.delay(n)
+
+    async def acquire(self, client: str, /) -> float:
+        "请求准入，成功时返回 0（之后需要调用 release），被拒绝时返回建议的重试秒数"
+        if delay := self.take_token(client):
+            self.stat["shed_rate"] += 1
+            return delay
+        # release 时总会放行所有能放行的等待者，所以此时仍在等待的，都不会因为这个请求被放行而受影响
+        if self.can_admit(client):
+            self.admit(client)
+            return 0
+        if len(self.waiters) >= self.queue_size:
+            self.stat["shed_queue_full"] += 1
+            return 1
+        self.stat["queued"] += 1
+        fut = get_running_loop().create_future()
+        entry = (client, fut)
+        self.waiters.append(entry)
+        try:
+            await wait((fut,), timeout=self.timeout)
+        except CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(client)
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+            try:
+                self.waiters.remove(entry)
+            except ValueError:
+                pass
+        if fut.cancelled():
+            self.stat["shed_timeout"] += 1
+            return 1
+        return 0
+
+    def release(self, client: str, /):
+        "结束一个已准入的请求，并按到达顺序放行能放行的等待者"
+        self.active -= 1
+        if (n := self.client_active[client] - 1) > 0:
+            self.client_active[client] = n
+        else:
+            del self.client_active[client]
+        if self.waiters:
+            waiters: deque[tuple[str, Future]] = deque()
+            for entry in self.waiters:
+                client, fut = entry
+                if fut.done():
+                    continue
+                if self.can_admit(client):
+                    self.admit(client)
+                    fut.set_result(None)
+                else:
+                    waiters.append(entry)
+            self.waiters = waiters
+
+    def status(self, /) -> dict:
+        return {
+            "limit": self.limit, 
+            "client_limit": self.client_limit, 
+            "queue_size": self.queue_size, 
+            "timeout": self.timeout, 
+            "client_rate": self.client_rate, 
+            "client_burst": self.client_burst, 
+            "active": self.active, 
+            "waiting": len(self.waiters), 
+            "clients": dict(sorted(self.client_active.items(), key=lambda t: t[1], reverse=True)[:10]), 
+            **self.stat, 
+        }
 
 
 def make_application(
     cids: int | str | Iterable[int | str] = "0", 
     interval: int | float = 5, 
+    max_interval: int | float = 3600, 
     store_file: str = "", 
     password: str = "", 
     token: str = "", 
-    cookies_path: str | Path = "", 
+    cookies_path: str | Path | Iterable[str | Path] = "", 
+    cache_size: int = 1024, 
+    max_workers: int = 1, 
+    rate: float = 0, 
+    burst: int = 10, 
+    retries: int = 3, 
+    account_rate: float = 0, 
+    account_burst: int = 5, 
+    account_eject: float = 60, 
+    compact_index: bool = False, 
+    dbfile: str = "", 
+    dbfile_interval: float = 1, 
+    prefetch_user_agents: Iterable[str] = (), 
+    refresh_ahead: float = 0, 
+    head_meta: bool = False, 
+    queue_workers: int = 1, 
+    max_concurrency: int = 0, 
+    max_client_concurrency: int = 0, 
+    admission_queue: int = 100, 
+    admission_timeout: float = 5, 
+    client_rate: float = 0, 
+    client_burst: int = 10, 
+    access_log: str = "", 
+    max_bulk_items: int = 100, 
 ) -> Application:
-    # cookies 保存路径
-    if cookies_path:
-        cookies_path = Path(cookies_path)
-    else:
-        cookies_path = Path(__file__).parent / "115-cookies.txt"
-    # 用来保存【视频名称】对应的【pickcode】
-    if store_file:
-        from shelve import open as open_shelve
-        NAME_TO_PICKCODE: MutableMapping[str, str] = open_shelve(store_file)
+    if P115Client is None:
+        raise ImportError("p115client is not installed")
+    # cookies 保存路径，每个路径对应一个账号
+    if isinstance(cookies_path, (str, Path)):
+        cookies_path = [cookies_path] if cookies_path else []
+    cookies_paths = [Path(path) for path in cookies_path if path]
+    if not cookies_paths:
+        cookies_paths = [Path(__file__).parent / "115-cookies.txt"]
+    # 用来保存【视频名称】对应的【pickcode】，如果提供了 dbfile，则直接查询 updatedb.py 维护的数据库，不再自己拉取
+    if dbfile:
+        NAME_TO_PICKCODE: MutableMapping[str, str] = SQLiteNameIndex(dbfile) # type: ignore
+    elif store_file:
+        con = connect(store_file)
+        con.execute("PRAGMA journal_mode = WAL;")
+        NAME_TO_PICKCODE = SQLiteMap(con, "name_to_pickcode", data=CompactNameIndex() if compact_index else None)
+    elif compact_index:
+        NAME_TO_PICKCODE = CompactNameIndex()
     else:
         NAME_TO_PICKCODE = {}
+    # 用来保存【视频名称】对应的【(文件大小, 更新时间)】，用于回答 HEAD 请求（仅当 head_meta 为 True 时才记录，不会持久化）
+    NAME_TO_META: dict[str, tuple[int, int]] = {}
     # 用来保存所有需要拉取的目录 id，如果某个目录 id 在其中的另一个之中，会被短时间内重复拉取
     if isinstance(cids, (int, str)):
         CIDS = {str(cids)}
     else:
         CIDS = set(map(str, cids))
-    # 用来保存【目录 id】对应的【目录里面最近一条视频文件的更新时间】
-    MAX_MTIME_MAP: dict[str, str] = {}
+    # 用来保存【目录 id】对应的【目录里面最近一条视频文件的更新时间】，和缓存保存在一起，以便重启后继续增量拉取
+    if store_file and not dbfile:
+        MAX_MTIME_MAP: MutableMapping[str, str] = SQLiteMap(con, "max_mtime")
+    else:
+        MAX_MTIME_MAP = {}
+    # 用来保存【(pickcode, User-Agent)】对应的【(直链, 失效时间戳)】，按最近使用的先后排序
+    URL_CACHE: OrderedDict[tuple[str, str], tuple[str, float]] = OrderedDict()
+    # 直链缓存的命中和未命中次数，以及因为合并到进行中的请求而省去的请求次数
+    URL_CACHE_STAT = {"hit": 0, "miss": 0, "shared": 0}
+    # 用来保存【(pickcode, User-Agent)】对应的【正在请求直链的任务】，相同的并发请求会合并
+    URL_INFLIGHT: dict[tuple[str, str], Task[str]] = {}
+    # 直链缓存会比直链本身的过期时间（由直链中的 t 参数指定）提前这么多秒失效
+    URL_EXPIRE_MARGIN = 60
+    # 新发现的视频，会在后台为这些 User-Agent 预先获取直链
+    PREFETCH_USER_AGENTS = list(dict.fromkeys(prefetch_user_agents))
+    # 等待预先获取直链的 pickcode
+    PREFETCH_QUEUE: Queue[str] = Queue()
+    # 是否启用预先获取直链（需要启用直链缓存，并且自己拉取目录）
+    prefetch = bool(PREFETCH_USER_AGENTS) and cache_size > 0 and not dbfile
+    # 在后台预先获取、提前刷新直链的次数，以及其中失败的次数
+    URL_BACKGROUND_STAT = {"prefetch": 0, "refresh": 0, "failed": 0}
+    # 调用 115 接口的耗时
+    API_LATENCY = {"download_url_app": Histogram(), "fs_files": Histogram()}
+    # 获取直链的各个阶段的耗时：检查签名、用名字查询 pickcode、查询直链缓存、请求 115（或等待进行中的请求）、构建重定向响应
+    STAGE_LATENCY = {
+        stage: Histogram((0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.025, 0.1, 0.5, 2.5))
+        for stage in ("sign", "name_lookup", "url_cache", "fetch", "redirect")
+    }
+    # 是否正在采样分析
+    profiling = False
+    # 用来保存【(路由, 方法, 状态码)】对应的【请求次数】
+    REQUEST_COUNT: defaultdict[tuple[str, str, int], int] = defaultdict(int)
+    # 用名字查询 pickcode 时的命中和未命中次数
+    NAME_CACHE_STAT = {"hit": 0, "miss": 0}
+    # HEAD 请求中，直接用缓存回答（重定向到缓存的直链，或者只返回文件信息）的次数，以及需要按 GET 处理的次数
+    HEAD_STAT = {"redirect": 0, "meta": 0, "fallback": 0}
+    # 用来保存【目录 id】对应的【最近一次拉取的耗时和条数，以及累计的拉取次数和条数】
+    LOAD_STAT: defaultdict[str, dict[str, float]] = defaultdict(lambda: {"seconds": 0, "items": 0, "runs": 0, "items_total": 0})
+    # 所有路由中，不带参数的那些路径，用于在统计时区分路由
+    ROUTE_PATHS: set[str] = set()
+    # 所有 115 接口调用共用的限流器
+    LIMITER = RateLimiter(rate, burst)
+    # 限流器中的优先级：获取直链（用户正在等待）优先于后台拉取目录
+    PRIORITY_USER, PRIORITY_BACKGROUND = 0, 1
+    # 重试时退避的基础秒数和最大秒数
+    BACKOFF_BASE, BACKOFF_MAX = 0.5, 30
+    # 获取直链的路由的准入控制（按客户端 ip 限制并发数和频率）
+    ADMISSION = AdmissionController(
+        limit=max_concurrency, 
+        client_limit=max_client_concurrency, 
+        queue_size=admission_queue, 
+        timeout=admission_timeout, 
+        client_rate=client_rate, 
+        client_burst=client_burst, 
+    )
+    # 批量获取直链时，每个请求最多同时向 115 发起的请求数
+    BULK_CONCURRENCY = 8
+    # 批量获取直链时，每个请求最多包含的条目数（names 和 pickcodes 合计）
+    MAX_BULK_ITEMS = max_bulk_items
     # 执行 POST 请求时所需要携带的密码
     PASSWORD = password
     # 排队任务（一次性运行，不在周期性运行的 cids 列表中）
@@ -139,38 +1135,269 @@ def make_application(
     ))
     docs.ui_providers.append(ReDocUIProvider())
     docs.bind_app(app)
-    # 日志对象
+    # 日志对象，日志经过队列，由后台线程写出，以免阻塞事件循环
     logger = getattr(app, "logger")
     handler = logging.StreamHandler()
     handler.setFormatter(logging.Formatter("[\x1b[1m%(asctime)s\x1b[0m] (\x1b[1;36m%(levelname)s\x1b[0m) \x1b[5;31m➜\x1b[0m %(message)s"))
-    logger.addHandler(handler)
-    # 批量任务中，正在运行的任务
-    running_task = None
+    log_queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    log_listeners = [QueueListener(log_queue, handler)]
+    # 访问日志（每行是一个 JSON 对象），同样经过队列写出
+    access_logger = logging.getLogger(f"{__name__}.access.{id(app)}")
+    access_logger.propagate = False
+    access_logger.setLevel(logging.INFO)
+    if access_log:
+        access_handler = logging.StreamHandler(stdout) if access_log == "-" else logging.FileHandler(access_log, encoding="utf-8")
+        access_handler.setFormatter(logging.Formatter("%(message)s"))
+        access_queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+        access_logger.addHandler(QueueHandler(access_queue))
+        log_listeners.append(QueueListener(access_queue, access_handler))
+    # 当前请求的访问日志记录，各个阶段可以往其中添加字段
+    ACCESS_RECORD: ContextVar[None | dict] = ContextVar("ACCESS_RECORD", default=None)
+    # 批量任务中，正在运行的 cid 及其任务
+    BRUNNING: dict[str, Task[int]] = {}
+    # 用来保存【目录 id】对应的【调度状态】，包括：下次拉取的时间戳 due、当前的轮询间隔 interval、最近一次开始拉取的时间戳 last
+    SCHEDULE: dict[str, dict[str, float]] = {}
+    # 按 due 排序的优先队列，元素为 (due, cid)，如果和 SCHEDULE 中不一致，则是过时的元素，取出时跳过
+    SCHEDULE_HEAP: list[tuple[float, str]] = []
     # 批量任务中，正在休眠
     waiting_task = None
-    # 队列任务中，正在运行的任务
-    qrunning_task = None
-    # 批量任务中运行的 cid
-    bcid = ""
-    # 队列任务中运行的 cid
-    qcid = ""
-
-    def iter_cids() -> Iterator[str]:
-        s: set[str] = set()
-        add_cid = s.add
-        cids: Iterable[str] = tuple(CIDS)
-        while cids:
-            for cid in cids:
-                if cid in CIDS:
-                    yield cid
-                    add_cid(cid)
-            cids = CIDS - s
+    # 用来保存队列任务中【正在运行的目录 id】对应的【任务】
+    QRUNNING: dict[str, Task[int]] = {}
+    # 在队列中等待的目录 id，用于去重
+    QPENDING: set[str] = set()
+    # 正在运行时又被加入队列的目录 id，运行结束后再运行一次（多次加入只算一次）
+    QRERUN: set[str] = set()
+
+    def schedule(cid: str, due: float, /):
+        "设置目录下次拉取的时间"
+        SCHEDULE[cid]["due"] = due
+        heappush(SCHEDULE_HEAP, (due, cid))
+
+    def sync_schedule(now: float, /):
+        "使调度表和 CIDS 保持一致，新增的目录立即拉取（如果 interval 为 inf 且已有缓存，则等待 /run）"
+        for cid in CIDS - SCHEDULE.keys():
+            SCHEDULE[cid] = {"due": inf, "interval": interval, "last": 0}
+            schedule(cid, inf if isinf(interval) and NAME_TO_PICKCODE else now)
+        for cid in SCHEDULE.keys() - CIDS:
+            if cid not in BRUNNING:
+                del SCHEDULE[cid]
+
+    def next_interval(last_interval: float, changed: bool, /) -> float:
+        "计算目录下一次的轮询间隔：有变化时重置为 interval，否则翻倍，但不超过 max_interval"
+        if changed or isinf(interval) or max_interval <= interval:
+            return interval
+        return max(interval, min(max(last_interval, 1) * 2, max_interval))
+
+    @contextmanager
+    def span(stage: str, /):
+        "统计获取直链的某个阶段的耗时"
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            STAGE_LATENCY[stage].observe(elapsed)
+            annotate(**{stage: elapsed})
+
+    def annotate(**fields):
+        "往当前请求的访问日志记录中添加字段"
+        if (record := ACCESS_RECORD.get()) is not None:
+            record.update(fields)
+
+    def get_url_expire(url: str, /) -> float:
+        "从直链的 t 参数中解析出缓存的失效时间戳，如果解析失败则返回 0"
+        for key, val in parse_qsl(urlsplit(url).query):
+            if key == "t":
+                try:
+                    return int(val) - URL_EXPIRE_MARGIN
+                except ValueError:
+                    break
+        return 0
+
+    def url_cache_get(key: tuple[str, str], /) -> str:
+        "从缓存中获取直链，如果不存在或已失效则返回空字符串"
+        try:
+            url, expire = URL_CACHE[key]
+        except KeyError:
+            URL_CACHE_STAT["miss"] += 1
+            return ""
+        if expire <= time():
+            del URL_CACHE[key]
+            URL_CACHE_STAT["miss"] += 1
+            return ""
+        URL_CACHE.move_to_end(key)
+        URL_CACHE_STAT["hit"] += 1
+        return url
+
+    def url_cache_set(key: tuple[str, str], url: str, /):
+        "把直链加入缓存，如果超过最大条数，则淘汰最久未使用的"
+        if cache_size <= 0:
+            return
+        expire = get_url_expire(url)
+        if expire <= time():
+            return
+        URL_CACHE[key] = (url, expire)
+        URL_CACHE.move_to_end(key)
+        while len(URL_CACHE) > cache_size:
+            URL_CACHE.popitem(last=False)
+
+    async def call_115(call: Callable[[], Awaitable[dict]], /, priority: int = PRIORITY_USER) -> dict:
+        "调用 115 接口，会先经过限流器，如果遇到临时性错误，则以带随机抖动的指数退避进行重试"
+        attempt = 0
+        while True:
+            await LIMITER.acquire(priority)
+            try:
+                return await call()
+            except Exception as e:
+                if attempt >= retries or not is_transient_error(e):
+                    raise
+                delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * uniform(0.5, 1.5)
+                attempt += 1
+                logger.warning(f"retry after {delay:.3f} seconds ({attempt}/{retries}): {type(e).__qualname__}: {e}")
+                await sleep(delay)
+
+    async def fetch_url(
+        pickcode: str, 
+        user_agent: str, 
+        client: ClientSession, 
+        pool: P115ClientPool, 
+        priority: int = PRIORITY_USER, 
+    ) -> str:
+        """请求 115 获取直链，并写入缓存，如果获取失败，则抛出 FileNotFoundError，第 2 个参数是接口的响应
+
+        如果所有账号都被限流或需要重新登录，则抛出 AccountUnavailableError
+        """
+        async def call() -> dict:
+            # 每次（包括重试）都重新选取账号，超时和网络错误等由 call_115 退避重试，不影响账号
+            for _ in range(len(pool.clients)):
+                index = await pool.acquire()
+                start = perf_counter()
+                try:
+                    resp = await pool.clients[index].download_url_app(
+                        pickcode, 
+                        headers={"User-Agent": user_agent}, 
+                        request=blacksheep_request, 
+                        session=client, 
+                        async_=True, 
+                    )
+                finally:
+                    elapsed = perf_counter() - start
+                    API_LATENCY["download_url_app"].observe(elapsed)
+                    # 任务创建时复制了发起请求的上下文，所以会记录到第一个请求的访问日志中
+                    annotate(api=elapsed, account=index)
+                if not is_account_error(resp):
+                    return resp
+                # 被限流、需要重新登录等错误，暂停使用此账号一段时间，并立即换一个账号重试
+                pool.eject(index)
+                logger.warning(f"account {index} ejected for {account_eject} seconds: {resp!r}")
+            raise AccountUnavailableError(EAGAIN, resp)
+        resp = await call_115(call, priority=priority)
+        if not resp["state"]:
+            raise FileNotFoundError(ENOENT, resp)
+        info = next(iter(resp["data"].values()))
+        if not dbfile:
+            NAME_TO_PICKCODE[info["file_name"]] = info["pick_code"]
+        url = info["url"]["url"]
+        url_cache_set((pickcode, user_agent), url)
+        return url
+
+    async def resolve_url(
+        pickcode: str, 
+        user_agent: str, 
+        client: ClientSession, 
+        pool: P115ClientPool, 
+    ) -> str:
+        "获取直链，优先从缓存获取，相同的 (pickcode, User-Agent) 的并发请求会共享同一个任务的结果或异常"
+        key = (pickcode, user_agent)
+        with span("url_cache"):
+            url = url_cache_get(key)
+        if url:
+            # 快要失效的直链，先返回旧的，同时在后台刷新
+            if refresh_ahead > 0 and key not in URL_INFLIGHT and URL_CACHE[key][1] - time() <= refresh_ahead:
+                URL_BACKGROUND_STAT["refresh"] += 1
+                fetch_url_in_background(key, client, pool)
+                annotate(cache="stale")
+            else:
+                annotate(cache="hit")
+            return url
+        try:
+            task = URL_INFLIGHT[key]
+            URL_CACHE_STAT["shared"] += 1
+            annotate(cache="shared")
+        except KeyError:
+            task = start_fetch_url(key, client, pool)
+            annotate(cache="miss")
+        # 等待者被取消时，不影响任务本身以及其它等待者
+        with span("fetch"):
+            return await shield(task)
+
+    def start_fetch_url(
+        key: tuple[str, str], 
+        client: ClientSession, 
+        pool: P115ClientPool, 
+        priority: int = PRIORITY_USER, 
+    ) -> Task[str]:
+        "创建获取直链的任务，并登记到 URL_INFLIGHT 中，以便相同的 (pickcode, User-Agent) 的请求进行合并"
+        task = URL_INFLIGHT[key] = create_task(fetch_url(*key, client, pool, priority))
+        def done_callback(task: Task[str], /):
+            URL_INFLIGHT.pop(key, None)
+            # 如果所有等待者都已经取消，也要取走异常，避免告警
+            if not task.cancelled():
+                task.exception()
+        task.add_done_callback(done_callback)
+        return task
+
+    def fetch_url_in_background(
+        key: tuple[str, str], 
+        client: ClientSession, 
+        pool: P115ClientPool, 
+    ) -> Task[str]:
+        "在后台（以较低的优先级）获取直链，失败时只记录日志"
+        task = start_fetch_url(key, client, pool, PRIORITY_BACKGROUND)
+        def done_callback(task: Task[str], /):
+            if not task.cancelled() and (e := task.exception()):
+                URL_BACKGROUND_STAT["failed"] += 1
+                logger.warning(f"can't fetch url in background: {key!r}: {type(e).__qualname__}: {e}")
+        task.add_done_callback(done_callback)
+        return task
+
+    async def prefetch_urls():
+        "从队列中逐个获取新发现的视频的 pickcode，为每个预设的 User-Agent 预先获取直链，放入缓存"
+        client = app.services.resolve(ClientSession)
+        pool = app.services.resolve(P115ClientPool)
+        while True:
+            pickcode = await PREFETCH_QUEUE.get()
+            try:
+                for user_agent in PREFETCH_USER_AGENTS:
+                    key = (pickcode, user_agent)
+                    if key in URL_CACHE or key in URL_INFLIGHT:
+                        continue
+                    URL_BACKGROUND_STAT["prefetch"] += 1
+                    task = fetch_url_in_background(key, client, pool)
+                    # 逐个进行，以免占满限流器中的令牌
+                    try:
+                        await shield(task)
+                    except FileNotFoundError:
+                        break
+                    except Exception:
+                        pass
+            finally:
+                PREFETCH_QUEUE.task_done()
 
     async def load_videos(cid: int | str = 0, /) -> int:
         "加载一个目录中的所有视频的 名字 和 pickcode 到缓存"
         client = app.services.resolve(ClientSession)
         p115client = app.services.resolve(P115Client)
-        fs_files = partial(p115client.fs_files, async_=True, request=blacksheep_request, session=client)
+        async def fs_files(payload: dict, /) -> dict:
+            async def call() -> dict:
+                start = perf_counter()
+                try:
+                    # 边接收边解析，只保留需要的字段，避免一次性把 10000 条数据完整地载入内存
+                    return await p115client.fs_files(payload, async_=True, request=request_fs_files_stream, session=client)
+                finally:
+                    API_LATENCY["fs_files"].observe(perf_counter() - start)
+            return await call_115(call, priority=PRIORITY_BACKGROUND)
         cid = str(cid)
         last_max_mtime = MAX_MTIME_MAP.get(cid, "0")
         page_size = 10_000 if last_max_mtime == "0" else 32
@@ -178,7 +1405,7 @@ def make_application(
             "asc": 0, "cid": cid, "count_folders": 0, "cur": 0, "limit": page_size, 
             "o": "user_utime", "offset": 0, "show_dir": 0, "type": 4, 
         }
-        resp = await fs_files(payload) # type: ignore
+        resp = await fs_files(payload)
         if (not resp["state"] or 
             cid != "0" and resp["path"][-1]["cid"] != cid or 
             resp["count"] == 0):
@@ -189,17 +1416,27 @@ def make_application(
         count = 0
         payload["limit"] = 10_000
         while True:
-            for info in resp["data"]:
-                mtime = info["te"]
-                if mtime <= last_max_mtime:
-                    MAX_MTIME_MAP[cid] = this_max_mtime
-                    return count
-                NAME_TO_PICKCODE[info["n"]] = info["pc"]
-                count += 1
+            # 每一页只写入一次（如果是 sqlite，则是一个事务）
+            data = resp["data"]
+            items = list(takewhile(lambda info: info["te"] > last_max_mtime, data))
+            pairs = [(info["n"], info["pc"]) for info in items]
+            if head_meta:
+                NAME_TO_META.update((info["n"], (int(info.get("s") or 0), int(info["te"]))) for info in items)
+            # 只在增量拉取时预先获取直链，首次拉取的全量数据太多，而且缓存也放不下
+            if prefetch and last_max_mtime != "0":
+                get = NAME_TO_PICKCODE.get
+                for name, pickcode in pairs:
+                    if get(name) != pickcode and PREFETCH_QUEUE.qsize() < cache_size:
+                        PREFETCH_QUEUE.put_nowait(pickcode)
+            NAME_TO_PICKCODE.update(pairs)
+            count += len(pairs)
+            if len(pairs) < len(data):
+                MAX_MTIME_MAP[cid] = this_max_mtime
+                return count
             payload["offset"] += len(resp["data"]) # type: ignore
             if payload["offset"] >= resp["count"]:
                 break
-            resp = await fs_files(payload) # type: ignore
+            resp = await fs_files(payload)
             if (not resp["state"] or 
                 cid != "0" and resp["path"][-1]["cid"] != cid or 
                 payload["offset"] != resp["offset"]):
@@ -207,80 +1444,225 @@ def make_application(
         MAX_MTIME_MAP[cid] = this_max_mtime
         return count
 
+    def record_load_videos(cid: str, count: int, seconds: float, /):
+        "记录一次成功拉取的耗时和条数"
+        stat = LOAD_STAT[cid]
+        stat["seconds"] = seconds
+        stat["items"] = count
+        stat["runs"] += 1
+        stat["items_total"] += count
+
     async def batch_load_videos():
-        "加载若干个目录中的所有视频的 名字 和 pickcode 到缓存"
-        nonlocal running_task, waiting_task, bcid
-        if isinf(interval) and NAME_TO_PICKCODE:
-            start = time()
-            while time() < start + interval:
-                waiting_task = create_task(sleep(interval))
+        "加载若干个目录中的所有视频的 名字 和 pickcode 到缓存，按照每个目录各自的下次拉取时间进行调度"
+        nonlocal waiting_task
+        def cancel_running(msg: str, /):
+            for task in BRUNNING.values():
+                task.cancel(msg)
+            BRUNNING.clear()
+        while True:
+            now = time()
+            sync_schedule(now)
+            # 取出到期的目录，最多同时运行 max_workers 个任务
+            while SCHEDULE_HEAP and len(BRUNNING) < max(max_workers, 1):
+                due, bcid = SCHEDULE_HEAP[0]
+                state = SCHEDULE.get(bcid)
+                if state is None or state["due"] != due or bcid in BRUNNING:
+                    heappop(SCHEDULE_HEAP)
+                    continue
+                if due > now:
+                    break
+                heappop(SCHEDULE_HEAP)
+                state["last"] = now
+                BRUNNING[bcid] = create_task(load_videos(bcid))
+            # 如果已经满员，则只等待任务完成，否则还要等待下一个目录到期
+            if len(BRUNNING) >= max(max_workers, 1) or not SCHEDULE_HEAP:
+                timeout = inf
+            else:
+                timeout = SCHEDULE_HEAP[0][0] - now
+            waiting_task = create_task(sleep(timeout))
+            try:
+                done, _ = await wait((waiting_task, *BRUNNING.values()), return_when=FIRST_COMPLETED)
+            except CancelledError:
+                waiting_task.cancel()
+                cancel_running("shutdown")
+                raise
+            if waiting_task in done:
                 try:
-                    await waiting_task
+                    waiting_task.result()
                 except CancelledError as e:
-                    if not e.args or e.args[0] == "shutdown":
+                    cmd = e.args[0] if e.args else "shutdown"
+                    if cmd == "shutdown":
+                        cancel_running("shutdown")
                         return
-                    cmd = e.args[0]
+                    now = time()
                     if cmd == "run":
-                        break
-                finally:
-                    waiting_task = None
-        while True:
-            start = time()
-            for bcid in iter_cids():
-                this_start = time()
-                running_task = create_task(load_videos(bcid))
+                        for cid in SCHEDULE:
+                            if cid not in BRUNNING:
+                                schedule(cid, now)
+                    elif cmd == "change":
+                        for cid, state in SCHEDULE.items():
+                            state["interval"] = interval
+                            if cid not in BRUNNING:
+                                schedule(cid, state["last"] + interval)
+            else:
+                waiting_task.cancel()
+            waiting_task = None
+            for bcid, task in tuple(BRUNNING.items()):
+                if not task.done():
+                    continue
+                del BRUNNING[bcid]
+                state = SCHEDULE[bcid]
                 try:
-                    count = await running_task
-                    logger.info(f"successfully loaded cid={bcid}, {count} items, {time() - this_start:.6f} seconds")
+                    count = task.result()
+                    seconds = time() - state["last"]
+                    record_load_videos(bcid, count, seconds)
+                    logger.info(f"successfully loaded cid={bcid}, {count} items, {seconds:.6f} seconds")
+                    state["interval"] = next_interval(state["interval"], count > 0)
                 except CancelledError as e:
                     logger.warning(f"task cancelled cid={bcid}")
                     if not e.args or e.args[0] == "shutdown":
+                        cancel_running("shutdown")
                         return
                     cmd = e.args[0]
                     if cmd == "sleep":
-                        break
+                        # 已经到期的目录也推迟一个间隔
+                        now = time()
+                        for cid, other in SCHEDULE.items():
+                            if other["due"] <= now and cid not in BRUNNING:
+                                schedule(cid, now + other["interval"])
                 except Exception:
                     logger.exception(f"error occurred while loading cid={bcid}")
-                finally:
-                    bcid = ""
-                    running_task = None
-            while time() < start + interval:
-                waiting_task = create_task(sleep(interval))
-                try:
-                    await waiting_task
-                except CancelledError as e:
-                    if not e.args or e.args[0] == "shutdown":
-                        return
-                    cmd = e.args[0]
-                    if cmd == "run":
-                        break
-                finally:
-                    waiting_task = None
+                schedule(bcid, state["last"] + state["interval"])
+
+    def enqueue(cid: str, /) -> str:
+        """把目录加入队列任务，返回处理结果
+
+        - promoted: 目录在批量任务中，让它立即到期
+        - running: 目录正在批量任务中运行
+        - coalesced: 目录正在队列任务中运行，结束后再运行一次
+        - pending: 目录已经在队列中等待
+        - queued: 加入队列
+        """
+        if cid in SCHEDULE:
+            if cid in BRUNNING:
+                return "running"
+            schedule(cid, time())
+            try:
+                waiting_task.cancel("wake") # type: ignore
+            except AttributeError:
+                pass
+            return "promoted"
+        if cid in QRUNNING:
+            QRERUN.add(cid)
+            return "coalesced"
+        if cid in QPENDING:
+            return "pending"
+        QPENDING.add(cid)
+        QUEUE.put_nowait(cid)
+        return "queued"
 
     async def queue_load_videos():
-        nonlocal qrunning_task, qcid
+        "从队列中逐个获取目录 id 并拉取，可以有多个同时运行"
         while True:
             qcid = await QUEUE.get()
-            qrunning_task = create_task(load_videos(qcid))
+            QPENDING.discard(qcid)
+            task = QRUNNING[qcid] = create_task(load_videos(qcid))
             try:
                 this_start = time()
-                count = await qrunning_task
-                logger.info(f"successfully loaded cid={qcid}, {count} items, {time() - this_start:.6f} seconds")
+                count = await task
+                seconds = time() - this_start
+                record_load_videos(qcid, count, seconds)
+                logger.info(f"successfully loaded cid={qcid}, {count} items, {seconds:.6f} seconds")
             except CancelledError as e:
                 logger.warning(f"task cancelled cid={qcid}")
                 if not e.args or e.args[0] == "shutdown":
+                    task.cancel("shutdown")
                     return
             except:
                 logger.exception(f"error occurred while loading cid={qcid}")
             finally:
-                qcid = ""
-                qrunning_task = None
+                del QRUNNING[qcid]
                 QUEUE.task_done()
+                if qcid in QRERUN:
+                    QRERUN.discard(qcid)
+                    enqueue(qcid)
 
     @app.on_middlewares_configuration
     def configure_forwarded_headers(app: Application):
         app.middlewares.insert(0, ForwardedHeadersMiddleware(accept_only_proxied_requests=False))
 
+    @app.on_middlewares_configuration
+    def configure_request_count(app: Application):
+        ROUTE_PATHS.update(route.pattern.decode("utf-8") for route in app.router if b"{" not in route.pattern)
+        async def count_requests(request: Request, handler):
+            path = request.path
+            route = path if path in ROUTE_PATHS else "/{name}"
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            finally:
+                REQUEST_COUNT[(route, request.method, status)] += 1
+        app.middlewares.append(count_requests)
+
+    @app.on_middlewares_configuration
+    def configure_access_log(app: Application):
+        if not access_log:
+            return
+        async def log_access(request: Request, handler):
+            record = {
+                "time": time(), 
+                "client": request.original_client_ip, 
+                "method": request.method, 
+                "path": request.path, 
+                "ua": (request.get_first_header(b"User-agent") or b"").decode("utf-8", "replace"), 
+            }
+            token = ACCESS_RECORD.set(record)
+            start = perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            finally:
+                ACCESS_RECORD.reset(token)
+                record["status"] = status
+                record["duration"] = perf_counter() - start
+                access_logger.info(dumps(record, ensure_ascii=False))
+        app.middlewares.append(log_access)
+
+    @app.on_middlewares_configuration
+    def configure_admission_control(app: Application):
+        if not ADMISSION.enabled:
+            return
+        # 在 ForwardedHeadersMiddleware 之后，所以 original_client_ip 是真实的客户端 ip
+        async def admission_control(request: Request, handler):
+            path = request.path
+            # 只限制获取直链的路由
+            if path in ROUTE_PATHS and path not in ("/", "/urls"):
+                return await handler(request)
+            client_ip = request.original_client_ip
+            if retry_after := await ADMISSION.acquire(client_ip):
+                response = json({"state": False, "message": "too many requests"}, 429)
+                response.add_header(b"Retry-After", str(ceil(retry_after)).encode("ascii"))
+                return response
+            try:
+                return await handler(request)
+            finally:
+                ADMISSION.release(client_ip)
+        app.middlewares.append(admission_control)
+
+    @app.lifespan
+    async def start_log_listeners(app: Application):
+        for listener in log_listeners:
+            listener.start()
+        try:
+            yield
+        finally:
+            for listener in log_listeners:
+                listener.stop()
+
     @app.lifespan
     async def register_client(app: Application):
         async with ClientSession(follow_redirects=False) as client:
@@ -289,72 +1671,202 @@ def make_application(
 
     @app.lifespan
     async def register_p115client(app: Application):
-        client = P115Client(
-            cookies_path, 
-            app="harmony", 
-            check_for_relogin=True, 
-        )
-        async with client.async_session:
-            app.services.register(P115Client, instance=client)
+        clients = [
+            P115Client(
+                path, 
+                app="harmony", 
+                check_for_relogin=True, 
+            )
+            for path in cookies_paths
+        ]
+        async with AsyncExitStack() as stack:
+            for client in clients:
+                await stack.enter_async_context(client.async_session)
+            # 第 1 个账号用于拉取目录，所有账号轮流用于获取直链
+            app.services.register(P115Client, instance=clients[0])
+            app.services.register(P115ClientPool, instance=P115ClientPool(
+                clients, 
+                rate=account_rate, 
+                burst=account_burst, 
+                eject_seconds=account_eject, 
+            ))
             yield
 
     @app.lifespan
-    async def start_tasks(app: Application):
-        batch_task = create_task(batch_load_videos())
-        queue_task = create_task(queue_load_videos())
+    async def close_store(app: Application):
         try:
             yield
         finally:
-            batch_task.cancel("shutdown")
-            queue_task.cancel("shutdown")
+            if dbfile:
+                NAME_TO_PICKCODE.close() # type: ignore
+            elif store_file:
+                con.close()
+
+    async def count_names():
+        "在线程中重新统计数据库中名字的数目，以免扫描整个表时阻塞事件循环"
+        version = NAME_TO_PICKCODE.data_version # type: ignore
+        length = await to_thread(NAME_TO_PICKCODE.count) # type: ignore
+        # 统计期间如果数据库又有变化，则等下一次统计
+        if NAME_TO_PICKCODE.data_version == version: # type: ignore
+            NAME_TO_PICKCODE.length = length # type: ignore
+
+    async def watch_dbfile():
+        "周期性地检查数据库是否有变化（由 updatedb.py 写入），如果有，则清空查询缓存，并重新统计名字的数目"
+        changed = True
+        while True:
+            try:
+                if changed:
+                    await count_names()
+                await sleep(dbfile_interval)
+                if changed := NAME_TO_PICKCODE.refresh(): # type: ignore
+                    logger.info(f"dbfile changed: {dbfile!r}")
+            except CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"can't check dbfile: {dbfile!r}")
+                await sleep(dbfile_interval)
 
-    async def get_url(
-        request: Request, 
+    @app.lifespan
+    async def start_tasks(app: Application):
+        if dbfile:
+            tasks = [create_task(watch_dbfile())]
+        else:
+            tasks = [create_task(batch_load_videos())]
+            tasks.extend(create_task(queue_load_videos()) for _ in range(max(queue_workers, 1)))
+            if prefetch:
+                tasks.append(create_task(prefetch_urls()))
+        try:
+            yield
+        finally:
+            for task in tasks:
+                task.cancel("shutdown")
+
+    def check_crawling() -> None | Response:
+        "如果提供了 dbfile，则不会拉取目录，和拉取相关的控制接口返回 409，否则返回 None"
+        if dbfile:
+            return json({"state": False, "message": "not available with dbfile, directories are not crawled"}, 409)
+        return None
+
+    def check_sign(value: str, sign: str = "", t: int = 0, /) -> None | tuple[int, dict]:
+        "检查签名，如果不通过，则返回 (状态码, 错误信息)"
+        if not token:
+            return None
+        if sign != sha1(bytes(f"302@115-{token}-{t}-{value}", "utf-8")).hexdigest():
+            return 403, {"state": False, "message": "invalid sign"}
+        elif t > 0 and t <= time():
+            return 401, {"state": False, "message": "url was expired"}
+        return None
+
+    async def resolve_name_or_pickcode(
         client: ClientSession, 
-        p115client: P115Client, 
+        pool: P115ClientPool, 
+        user_agent: str = "", 
         name: str = "", 
         pickcode: str = "", 
         sign: str = "", 
         t: int = 0, 
-    ):
-        def check_sign(value, /):
-            if not token:
-                return None
-            if sign != sha1(bytes(f"302@115-{token}-{t}-{value}", "utf-8")).hexdigest():
-                return json({"state": False, "message": "invalid sign"}, 403)
-            elif t > 0 and t <= time():
-                return json({"state": False, "message": "url was expired"}, 401)
+    ) -> tuple[int, str | dict]:
+        "检查签名并获取直链，成功时返回 (302, 直链)，否则返回 (状态码, 错误信息)"
         if pickcode := pickcode.strip():
-            if resp := check_sign(pickcode):
-                return resp
+            with span("sign"):
+                error = check_sign(pickcode, sign, t)
+            if error:
+                return error
         else:
             if not name:
-                return json({"state": False, "message": "please provide a name or pickcode"}, 400)
-            if resp := check_sign(name):
-                return resp
+                return 400, {"state": False, "message": "please provide a name or pickcode"}
+            with span("sign"):
+                error = check_sign(name, sign, t)
+            if error:
+                return error
+            try:
+                with span("name_lookup"):
+                    pickcode = NAME_TO_PICKCODE[name]
+                NAME_CACHE_STAT["hit"] += 1
+            except KeyError:
+                NAME_CACHE_STAT["miss"] += 1
+                return 404, {"state": False, "message": f"name not found: {name!r}"}
+        try:
+            return 302, await resolve_url(pickcode, user_agent, client, pool)
+        except FileNotFoundError as e:
+            return 404, e.args[1]
+        except AccountUnavailableError as e:
+            return 503, {"state": False, "message": "all accounts are throttled or need to relogin", "response": e.args[1]}
+
+    def get_meta(name: str, /) -> None | tuple[int, int]:
+        "获取视频的 (文件大小, 更新时间)，如果没有记录则返回 None"
+        if dbfile:
+            return NAME_TO_PICKCODE.get_meta(name) # type: ignore
+        return NAME_TO_META.get(name)
+
+    def head_from_cache(
+        user_agent: str = "", 
+        name: str = "", 
+        pickcode: str = "", 
+        sign: str = "", 
+        t: int = 0, 
+    ) -> None | Response:
+        """只用缓存回答 HEAD 请求，不请求 115，如果返回 None，则需要按 GET 处理
+
+        如果缓存中有直链，则重定向到它，否则只要文件名在缓存中，就返回 200，并尽量附带文件大小和更新时间
+        """
+        if pickcode := pickcode.strip():
+            if error := check_sign(pickcode, sign, t):
+                return json(error[1], error[0])
+            name = ""
+        elif name:
+            if error := check_sign(name, sign, t):
+                return json(error[1], error[0])
             try:
                 pickcode = NAME_TO_PICKCODE[name]
+                NAME_CACHE_STAT["hit"] += 1
             except KeyError:
+                NAME_CACHE_STAT["miss"] += 1
                 return json({"state": False, "message": f"name not found: {name!r}"}, 404)
+        else:
+            return None
+        # 只是查看，不影响直链缓存的统计和淘汰顺序
+        url, expire = URL_CACHE.get((pickcode, user_agent), ("", 0))
+        if expire > time():
+            HEAD_STAT["redirect"] += 1
+            return redirect(url)
+        # 只有 pickcode 时，不能确定文件是否存在
+        if not name:
+            return None
+        HEAD_STAT["meta"] += 1
+        headers = [(b"X-Pickcode", pickcode.encode("ascii"))]
+        if meta := get_meta(name):
+            size, mtime = meta
+            headers.append((b"X-File-Size", str(size).encode("ascii")))
+            headers.append((b"Last-Modified", formatdate(mtime, usegmt=True).encode("ascii")))
+        return Response(200, headers)
+
+    async def get_url(
+        request: Request, 
+        client: ClientSession, 
+        pool: P115ClientPool, 
+        name: str = "", 
+        pickcode: str = "", 
+        sign: str = "", 
+        t: int = 0, 
+    ):
         user_agent = (request.get_first_header(b"User-agent") or b"").decode("utf-8")
-        resp = await p115client.download_url_app(
-            pickcode, 
-            headers={"User-Agent": user_agent}, 
-            request=blacksheep_request, 
-            session=client, 
-            async_=True, 
-        )
-        if not resp["state"]:
-            return json(resp, 404)
-        info = next(iter(resp["data"].values()))
-        NAME_TO_PICKCODE[info["file_name"]] = info["pick_code"]
-        return redirect(info["url"]["url"])
+        if request.method == "HEAD":
+            if (response := head_from_cache(user_agent, name=name, pickcode=pickcode, sign=sign, t=t)) is not None:
+                return response
+            HEAD_STAT["fallback"] += 1
+        status, result = await resolve_name_or_pickcode(
+            client, pool, user_agent, name=name, pickcode=pickcode, sign=sign, t=t)
+        if isinstance(result, str):
+            with span("redirect"):
+                return redirect(result)
+        return json(result, status)
 
     @app.router.route("/", methods=["GET", "HEAD"])
     async def get_url_by_pickcode(
         request: Request, 
         client: ClientSession, 
-        p115client: P115Client, 
+        pool: P115ClientPool, 
         pickcode: str = "", 
         sign: str = "", 
         t: int = 0, 
@@ -370,13 +1882,13 @@ def make_application(
 
         :return: 文件的直链
         """
-        return await get_url(request, client, p115client, pickcode=pickcode)
+        return await get_url(request, client, pool, pickcode=pickcode)
 
     @app.router.route("/{path:name}", methods=["GET", "HEAD"])
     async def get_url_by_pickcode_or_name(
         request: Request, 
         client: ClientSession, 
-        p115client: P115Client, 
+        pool: P115ClientPool, 
         name: str = "", 
         pickcode: str = "", 
         sign: str = "", 
@@ -384,6 +1896,8 @@ def make_application(
     ):
         """获取文件直链，仅支持用文件名查询视频文件，或者用 pickcode 查询任意文件
 
+        HEAD 请求只用缓存回答：缓存中有直链时重定向，否则只要文件名在缓存中，就返回 200（不请求 115）
+
         :param name: 文件名
         :param pickcode: 文件的提取码，优先级高于 `name`
         :param sign: 签名，计算方式为 `hashlib.sha1(bytes(f"302@115-{token}-{t}-{value}", "utf-8")).hexdigest()`
@@ -394,20 +1908,164 @@ def make_application(
 
         :return: 文件的直链
         """
-        return await get_url(request, client, p115client, name=name, pickcode=pickcode)
+        return await get_url(request, client, pool, name=name, pickcode=pickcode)
+
+    @app.router.route("/urls", methods=["POST"])
+    async def get_urls(
+        request: Request, 
+        client: ClientSession, 
+        pool: P115ClientPool, 
+        body: None | FromJSON[dict] = None, 
+    ):
+        """批量获取文件直链，会并发请求（但有上限），返回【名字或 pickcode】对应的【直链或错误信息】
+
+        :param body: 请求体为 json 格式 <code>{"names"&colon; [...], "pickcodes"&colon; [...], "user_agent"&colon; "..."}</code>
+            <br />- **names**&colon; 文件名的列表，每一项是字符串，或者 <code>{"name"&colon; "...", "sign"&colon; "...", "t"&colon; 0}</code>
+            <br />- **pickcodes**&colon; 提取码的列表，每一项是字符串，或者 <code>{"pickcode"&colon; "...", "sign"&colon; "...", "t"&colon; 0}</code>
+            <br />- **user_agent**&colon; 直链所绑定的 User-Agent，如果不提供，则用此请求的 User-Agent
+            <br />签名的计算方式同 `/{name}` 接口
+            <br />names 和 pickcodes 合计最多 `-mb/--max-bulk-items` 项，超出则返回 413
+            <br />某一项获取失败时，只有这一项返回错误信息（其中的 status 是对应的状态码），不影响其它项
+        """
+        payload = body.value if body else {}
+        total = sum(len(items) for field in ("names", "pickcodes") if isinstance(items := payload.get(field), list))
+        if total > MAX_BULK_ITEMS:
+            return json({"state": False, "message": f"too many items: {total} > {MAX_BULK_ITEMS}"}, 413)
+        # 准入控制时已经取走了 1 个令牌，其余的每项各取 1 个
+        if total > 1 and ADMISSION.enabled:
+            if retry_after := ADMISSION.take_token(request.original_client_ip, total - 1):
+                ADMISSION.stat["shed_rate"] += 1
+                response = json({"state": False, "message": "too many requests"}, 429)
+                response.add_header(b"Retry-After", str(ceil(retry_after)).encode("ascii"))
+                return response
+        user_agent = payload.get("user_agent")
+        if not isinstance(user_agent, str):
+            user_agent = (request.get_first_header(b"User-agent") or b"").decode("utf-8")
+        sema = Semaphore(BULK_CONCURRENCY)
+        async def resolve(key: str, item: str | dict, /) -> tuple[str, str, dict]:
+            if isinstance(item, str):
+                item = {key: item}
+            elif not isinstance(item, dict):
+                return key, str(item), {"state": False, "message": "invalid item"}
+            value = str(item.get(key) or "")
+            try:
+                t = int(item.get("t") or 0)
+            except (TypeError, ValueError):
+                return key, value, {"state": False, "message": "invalid t"}
+            # 单项出错（重试后仍然超时、HTTP 错误、115 的响应格式不对等）只影响这一项，不让整批请求失败
+            try:
+                async with sema:
+                    status, result = await resolve_name_or_pickcode(
+                        client, 
+                        pool, 
+                        user_agent, 
+                        sign=str(item.get("sign") or ""), 
+                        t=t, 
+                        **{key: value}, 
+                    )
+            except Exception as e:
+                logger.warning(f"can't resolve {key}={value!r}: {type(e).__qualname__}: {e}")
+                status = 502 if isinstance(e, (HTTPException, OSError)) else 500
+                return key, value, {"state": False, "message": f"{type(e).__qualname__}: {e}", "status": status}
+            if isinstance(result, str):
+                return key, value, {"state": True, "url": result}
+            return key, value, {**result, "status": status}
+        tasks = [
+            resolve(key, item)
+            for key, field in (("name", "names"), ("pickcode", "pickcodes"))
+            if isinstance(items := payload.get(field), list)
+            for item in items
+        ]
+        value: dict[str, dict[str, dict]] = {"names": {}, "pickcodes": {}}
+        for key, item_value, result in await gather(*tasks):
+            value[key + "s"][item_value] = result
+        return json({"state": True, "message": "ok", "value": value})
+
+    @app.router.route("/metrics", methods=["GET"])
+    async def get_metrics(request: Request, password: str = ""):
+        """Prometheus 格式的监控指标
+
+        :param password: 口令
+        """
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        prefix = "video_115_302_"
+        lines: list[str] = []
+        push = lines.append
+        push(f"# TYPE {prefix}api_duration_seconds histogram")
+        for api, histogram in API_LATENCY.items():
+            lines.extend(histogram.expose(f"{prefix}api_duration_seconds", api=api))
+        push(f"# TYPE {prefix}get_url_stage_duration_seconds histogram")
+        for stage, histogram in STAGE_LATENCY.items():
+            lines.extend(histogram.expose(f"{prefix}get_url_stage_duration_seconds", stage=stage))
+        push(f"# TYPE {prefix}requests_total counter")
+        for (route, method, status), n in REQUEST_COUNT.items():
+            push(f"{prefix}requests_total{format_labels(route=route, method=method, status=str(status))} {n}")
+        push(f"# TYPE {prefix}name_cache_size gauge")
+        push(f"{prefix}name_cache_size {len(NAME_TO_PICKCODE)}")
+        name_index = NAME_TO_PICKCODE.data if isinstance(NAME_TO_PICKCODE, SQLiteMap) else NAME_TO_PICKCODE
+        if isinstance(name_index, CompactNameIndex):
+            push(f"# TYPE {prefix}name_cache_bytes gauge")
+            push(f"{prefix}name_cache_bytes {name_index.memory_usage()}")
+        push(f"# TYPE {prefix}name_cache_lookups_total counter")
+        for result, n in NAME_CACHE_STAT.items():
+            push(f"{prefix}name_cache_lookups_total{format_labels(result=result)} {n}")
+        push(f"# TYPE {prefix}head_requests_total counter")
+        for result, n in HEAD_STAT.items():
+            push(f"{prefix}head_requests_total{format_labels(result=result)} {n}")
+        push(f"# TYPE {prefix}url_cache_size gauge")
+        push(f"{prefix}url_cache_size {len(URL_CACHE)}")
+        push(f"# TYPE {prefix}url_cache_lookups_total counter")
+        for result, n in URL_CACHE_STAT.items():
+            push(f"{prefix}url_cache_lookups_total{format_labels(result=result)} {n}")
+        push(f"# TYPE {prefix}url_background_fetches_total counter")
+        for kind, n in URL_BACKGROUND_STAT.items():
+            push(f"{prefix}url_background_fetches_total{format_labels(kind=kind)} {n}")
+        push(f"# TYPE {prefix}url_prefetch_queue_depth gauge")
+        push(f"{prefix}url_prefetch_queue_depth {PREFETCH_QUEUE.qsize()}")
+        for key, kind, metric in (
+            ("seconds", "gauge", "load_videos_last_duration_seconds"), 
+            ("items", "gauge", "load_videos_last_items"), 
+            ("runs", "counter", "load_videos_runs_total"), 
+            ("items_total", "counter", "load_videos_items_total"), 
+        ):
+            push(f"# TYPE {prefix}{metric} {kind}")
+            for cid, stat in LOAD_STAT.items():
+                push(f"{prefix}{metric}{format_labels(cid=cid)} {stat[key]}")
+        push(f"# TYPE {prefix}rate_limiter_waiting gauge")
+        push(f"{prefix}rate_limiter_waiting {sum(not w[2].done() for w in LIMITER.waiters)}")
+        if ADMISSION.enabled:
+            push(f"# TYPE {prefix}admission_active gauge")
+            push(f"{prefix}admission_active {ADMISSION.active}")
+            push(f"# TYPE {prefix}admission_waiting gauge")
+            push(f"{prefix}admission_waiting {len(ADMISSION.waiters)}")
+            push(f"# TYPE {prefix}admission_requests_total counter")
+            for result, n in ADMISSION.stat.items():
+                push(f"{prefix}admission_requests_total{format_labels(result=result)} {n}")
+        push(f"# TYPE {prefix}queue_depth gauge")
+        push(f"{prefix}queue_depth {QUEUE.qsize()}")
+        push(f"# TYPE {prefix}queue_running gauge")
+        push(f"{prefix}queue_running {len(QRUNNING)}")
+        push("")
+        return Response(200, content=Content(b"text/plain; version=0.0.4; charset=utf-8", "\n".join(lines).encode("utf-8")))
 
     @app.router.route("/run", methods=["POST"])
     async def do_run(request: Request, cid: str = "", password: str = ""):
         """运行后台任务
 
-        :param cid: 如果不传 cid，则运行批量任务（正在运行则跳过，正在睡眠则运行一次）；如果传入 cid，则加入队列任务（只会被运行一次）
+        :param cid: 如果不传 cid，则让批量任务中所有目录立即到期（正在运行的目录除外）；如果传入 cid，则加入队列任务（只会被运行一次）
+            <br />- 如果 cid 在批量任务中，则让它立即到期
+            <br />- 如果 cid 已经在队列中等待，则忽略；如果正在队列任务中运行，则结束后再运行一次
         :param password: 口令
+
+        :return: 如果传入 cid，则 value 为处理结果：promoted、running、coalesced、pending 或 queued
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
+        if resp := check_crawling():
+            return resp
         if cid:
-            QUEUE.put_nowait(cid)
-            return json({"state": True, "message": "ok"})
+            return json({"state": True, "message": "ok", "value": enqueue(cid)})
         try:
             waiting_task.cancel("run") # type: ignore
             return json({"state": True, "message": "ok"})
@@ -416,48 +2074,52 @@ def make_application(
 
     @app.router.route("/sleep", methods=["POST"])
     async def do_sleep(request: Request, password: str = ""):
-        """终止运行批量开始，睡眠一定时间，如果正在睡眠则跳过
+        """终止批量任务中正在运行的任务，并把已经到期的目录推迟一个间隔，如果没有正在运行的任务则跳过
 
         :param password: 口令
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
-        try:
-            running_task.cancel("sleep") # type: ignore
-            return json({"state": True, "message": "ok"})
-        except AttributeError:
+        if not BRUNNING:
             return json({"state": True, "message": "skip"})
+        for task in BRUNNING.values():
+            task.cancel("sleep")
+        return json({"state": True, "message": "ok"})
 
     @app.router.route("/skip", methods=["POST"])
     async def do_skip(request: Request, cid: str = "", password: str = ""):
         """跳过当前批量任务中正在运行的任务
 
-        :param cid: 如果提供，则仅当正在运行的 cid 等于此 cid 时，才会取消任务
+        :param cid: 如果提供，则仅取消正在运行的此 cid 的任务，否则取消所有正在运行的任务
         :param password: 口令
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
-        try:
-            if not cid or cid == bcid:
-                running_task.cancel("skip") # type: ignore
-        except AttributeError:
-            pass
+        if cid:
+            if task := BRUNNING.get(cid):
+                task.cancel("skip")
+        else:
+            for task in BRUNNING.values():
+                task.cancel("skip")
         return json({"state": True, "message": "ok"})
 
     @app.router.route("/qskip", methods=["POST"])
     async def do_qskip(request: Request, cid: str = "", password: str = ""):
         """跳过当前队列任务中正在运行的任务
 
-        :param cid: 如果提供，则仅当正在运行的 cid 等于此 cid 时，才会取消任务
+        :param cid: 如果提供，则仅取消正在运行的此 cid 的任务，否则取消所有正在运行的任务
         :param password: 口令
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
-        try:
-            if not cid or cid == qcid:
-                qrunning_task.cancel("skip") # type: ignore
-        except AttributeError:
-            pass
+        if cid:
+            if task := QRUNNING.get(cid):
+                QRERUN.discard(cid)
+                task.cancel("skip")
+        else:
+            QRERUN.clear()
+            for task in QRUNNING.values():
+                task.cancel("skip")
         return json({"state": True, "message": "ok"})
 
     @app.router.route("/running", methods=["POST"])
@@ -468,10 +2130,11 @@ def make_application(
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
-        if running_task is None:
+        if not BRUNNING:
             return json({"state": True, "message": "ok", "value": False})
         else:
-            return json({"state": True, "message": "ok", "value": True, "cid": bcid})
+            cids = list(BRUNNING)
+            return json({"state": True, "message": "ok", "value": True, "cid": cids[0], "cids": cids})
 
     @app.router.route("/qrunning", methods=["POST"])
     async def get_queue_task_running(request: Request, password: str = ""):
@@ -481,14 +2144,55 @@ def make_application(
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
-        if qrunning_task is None:
-            return json({"state": True, "message": "ok", "value": False})
+        pending = list(getattr(QUEUE, "_queue"))
+        if not QRUNNING:
+            return json({"state": True, "message": "ok", "value": False, "pending": pending})
         else:
-            return json({"state": True, "message": "ok", "value": True, "cid": qcid, "pending": list(getattr(QUEUE, "_queue"))})
+            cids = list(QRUNNING)
+            return json({"state": True, "message": "ok", "value": True, "cid": cids[0], "cids": cids, "pending": pending})
+
+    @app.router.route("/profile", methods=["POST"])
+    async def do_profile(request: Request, seconds: float = 10, interval: float = 0.005, password: str = ""):
+        """对事件循环所在的线程进行采样分析，持续若干秒后，返回折叠格式的调用栈（每行是 “调用栈 采样次数”），可以用 flamegraph.pl 或 speedscope 生成火焰图
+
+        :param seconds: 采样的秒数，不超过 300
+        :param interval: 采样的间隔秒数
+        :param password: 口令
+        """
+        nonlocal profiling
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        if not (0 < seconds <= 300 and 0 < interval < seconds):
+            return json({"state": False, "message": "invalid seconds or interval"}, 400)
+        if profiling:
+            return json({"state": False, "message": "profiler is already running"}, 409)
+        profiling = True
+        try:
+            stacks = await get_running_loop().run_in_executor(None, sample_stacks, get_ident(), seconds, interval)
+        finally:
+            profiling = False
+        return text("\n".join(f"{stack} {n}" for stack, n in stacks.most_common()))
+
+    @app.router.route("/spans", methods=["POST"])
+    async def get_spans(request: Request, password: str = ""):
+        """获取直链的各个阶段（sign、name_lookup、url_cache、fetch、redirect）的累计次数、累计耗时和平均耗时（秒）
+
+        :param password: 口令
+        """
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        return json({"state": True, "message": "ok", "value": {
+            stage: {
+                "count": histogram.count, 
+                "sum": histogram.sum, 
+                "avg": histogram.sum / histogram.count if histogram.count else 0, 
+            }
+            for stage, histogram in STAGE_LATENCY.items()
+        }})
 
     @app.router.route("/interval", methods=["POST"])
     async def set_interval(request: Request, value: float = nan, password: str = ""):
-        """修改两次开始批量任务的最小时间间隔
+        """修改每个目录两次开始拉取的最小时间间隔，所有目录当前的轮询间隔都会重置为此值
 
         :param value: 如果不传入值，则获取原值，如果传入 inf，则永久睡眠
         :param password: 口令
@@ -497,6 +2201,8 @@ def make_application(
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
         if not isnan(value):
+            if resp := check_crawling():
+                return resp
             interval = value
             try:
                 waiting_task.cancel("change") # type: ignore
@@ -505,26 +2211,111 @@ def make_application(
             return json({"state": True, "message": "ok", "value": interval})
         return json({"state": True, "message": "skip", "value": interval})
 
+    @app.router.route("/schedule", methods=["POST"])
+    async def get_schedule(request: Request, password: str = ""):
+        """获取批量任务中每个目录的调度状态
+
+        :param password: 口令
+
+        :return: 目录 id 对应的 <code>{"due"&colon; 下次拉取的时间戳, "interval"&colon; 当前轮询间隔, "last"&colon; 最近一次开始拉取的时间戳, "running"&colon; 是否正在运行}</code>，如果为 null 则表示无穷大
+        """
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        def finite(value: float, /) -> None | float:
+            return None if isinf(value) else value
+        return json({"state": True, "message": "ok", "value": {
+            cid: {
+                "due": finite(state["due"]), 
+                "interval": finite(state["interval"]), 
+                "last": state["last"], 
+                "running": cid in BRUNNING, 
+            } for cid, state in SCHEDULE.items()
+        }})
+
+    @app.router.route("/workers", methods=["POST"])
+    async def set_max_workers(request: Request, value: int = 0, password: str = ""):
+        """修改批量任务中，同时拉取的目录数
+
+        :param value: 如果不传入值（或者 <= 0），则获取原值
+        :param password: 口令
+        """
+        nonlocal max_workers
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        if value > 0:
+            if resp := check_crawling():
+                return resp
+            max_workers = value
+            try:
+                waiting_task.cancel("wake") # type: ignore
+            except AttributeError:
+                pass
+            return json({"state": True, "message": "ok", "value": max_workers})
+        return json({"state": True, "message": "skip", "value": max_workers})
+
+    @app.router.route("/cache", methods=["POST"])
+    async def get_cache_info(request: Request, clear: bool = False, password: str = ""):
+        """直链缓存的统计信息
+
+        :param clear: 是否清空直链缓存（统计的命中次数不清零）
+        :param password: 口令
+        """
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        if clear:
+            URL_CACHE.clear()
+        return json({"state": True, "message": "ok", "value": {
+            "size": len(URL_CACHE), 
+            "maxsize": cache_size, 
+            **URL_CACHE_STAT, 
+            "background": {**URL_BACKGROUND_STAT, "queue": PREFETCH_QUEUE.qsize()}, 
+        }})
+
     @app.router.route("/cookies", methods=["POST"])
-    async def set_cookies(request: Request, p115client: P115Client, password: str = "", body: None | FromJSON[dict] = None):
+    async def set_cookies(request: Request, pool: P115ClientPool, password: str = "", body: None | FromJSON[dict] = None):
         """更新 cookies
 
         :param password: 口令
-        :param body: 请求体为 json 格式 <code>{"value"&colon; "新的 cookies"}</code>
+        :param body: 请求体为 json 格式 <code>{"value"&colon; "新的 cookies", "account"&colon; 0}</code>
+            <br />- **account**&colon; 账号的索引（按命令行中传入 cookies 文件路径的顺序，从 0 开始），默认为 0
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
         if body:
             payload = body.value
             cookies = payload.get("value")
+            account = payload.get("account", 0)
+            if not isinstance(account, int) or not 0 <= account < len(pool.clients):
+                return json({"state": False, "message": f"no such account: {account!r}"})
             if isinstance(cookies, str):
                 try:
-                    p115client.cookies = cookies
+                    pool.clients[account].cookies = cookies
+                    pool.restore(account)
                     return json({"state": True, "message": "ok"})
                 except Exception as e:
                     return json({"state": False, "message": str(e)})
         return json({"state": True, "message": "skip"})
 
+    @app.router.route("/admission", methods=["POST"])
+    async def get_admission_info(request: Request, password: str = ""):
+        """获取直链的路由的准入控制的状态：限制、正在处理和排队的请求数、占用最多的客户端，以及累计放行和拒绝的次数
+
+        :param password: 口令
+        """
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        return json({"state": True, "message": "ok", "value": ADMISSION.status()})
+
+    @app.router.route("/accounts", methods=["POST"])
+    async def get_accounts(request: Request, pool: P115ClientPool, password: str = ""):
+        """获取各个账号的状态（被暂停的剩余秒数、空闲秒数、剩余令牌数）
+
+        :param password: 口令
+        """
+        if PASSWORD and PASSWORD != password:
+            return json({"state": False, "message": "password does not match"}, 401)
+        return json({"state": True, "message": "ok", "value": pool.status()})
+
     @app.router.route("/cids", methods=["POST"])
     async def get_cids(request: Request, password: str = ""):
         """获取 cid 列表，用于批量任务
@@ -544,15 +2335,22 @@ def make_application(
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
+        if resp := check_crawling():
+            return resp
         if body:
             payload = body.value
             cids_new = payload.get("value")
             if isinstance(cids_new, (int, str)):
                 CIDS.add(str(cids_new))
-                return json({"state": True, "message": "ok", "value": list(CIDS)})
             elif isinstance(cids_new, list):
                 CIDS.update(map(str, cids_new))
-                return json({"state": True, "message": "ok", "value": list(CIDS)})
+            else:
+                return json({"state": True, "message": "skip", "value": list(CIDS)})
+            try:
+                waiting_task.cancel("wake") # type: ignore
+            except AttributeError:
+                pass
+            return json({"state": True, "message": "ok", "value": list(CIDS)})
         return json({"state": True, "message": "skip", "value": list(CIDS)})
 
     @app.router.route("/cids/discard", methods=["POST"])
@@ -564,6 +2362,8 @@ def make_application(
         """
         if PASSWORD and PASSWORD != password:
             return json({"state": False, "message": "password does not match"}, 401)
+        if resp := check_crawling():
+            return resp
         if body:
             payload = body.value
             cids_new = payload.get("value")
@@ -589,10 +2389,34 @@ if __name__ == "__main__":
     app = make_application(
         cids=args.cids, 
         interval=args.interval, 
+        max_interval=args.max_interval, 
         store_file=args.store_file, 
         password=args.password or "", 
         token=args.token, 
         cookies_path=args.cookies_path, 
+        rate=args.rate, 
+        burst=args.burst, 
+        retries=args.retries, 
+        account_rate=args.account_rate, 
+        account_burst=args.account_burst, 
+        account_eject=args.account_eject, 
+        compact_index=args.compact_index, 
+        dbfile=args.dbfile, 
+        dbfile_interval=args.dbfile_interval, 
+        prefetch_user_agents=args.prefetch_user_agent, 
+        refresh_ahead=args.refresh_ahead, 
+        head_meta=args.head_meta, 
+        queue_workers=args.queue_workers, 
+        max_concurrency=args.max_concurrency, 
+        max_client_concurrency=args.max_client_concurrency, 
+        admission_queue=args.admission_queue, 
+        admission_timeout=args.admission_timeout, 
+        client_rate=args.client_rate, 
+        client_burst=args.client_burst, 
+        access_log=args.access_log, 
+        max_bulk_items=args.max_bulk_items, 
+        cache_size=args.cache_size, 
+        max_workers=args.max_workers, 
     )
     uvicorn.run(
         app=app, 